@@ -11,6 +11,14 @@ const Cairo = imports.cairo;
 const Gio = imports.gi.Gio;
 const ByteArray = imports.byteArray;
 
+const SAMPLER_CONNECT_RETRIES = 10;
+const SAMPLER_RETRY_DELAY = 300;
+// The same warning or error is logged at most LOG_REPEAT_BURST times per
+// LOG_REPEAT_WINDOW seconds
+const LOG_REPEAT_BURST = 5;
+const LOG_REPEAT_WINDOW = 60;
+const LOG_REPEAT_KEYS = 256;
+
 function CmdChartApplet(orientation, panel_height, instance_id, metadata) {
     this._init(orientation, panel_height, instance_id, metadata);
 }
@@ -24,6 +32,7 @@ CmdChartApplet.prototype = {
         try {
             this.panel_height = panel_height;
             this.uuid = metadata.uuid;
+            this.appletPath = metadata.path;
             this.instance_id = instance_id;
 
             this.set_applet_tooltip(_("CMD Chart Applet"));
@@ -33,6 +42,8 @@ CmdChartApplet.prototype = {
                                      "command", "command", this.on_settings_changed, null);
             this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
                                      "update-interval", "updateInterval", this.on_settings_changed, null);
+            this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
+                                     "command-timeout", "commandTimeout", this.on_settings_changed, null);
             this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
                                      "chart-width", "chartWidth", this.on_settings_changed, null);
             this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
@@ -53,6 +64,8 @@ CmdChartApplet.prototype = {
                                      "verbose-logging", "verboseLogging", this.on_settings_changed, null);
             this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
                                      "graph-points", "graphPoints", this.on_settings_changed, null);
+            this.settings.bindProperty(Settings.BindingDirection.BIDIRECTIONAL,
+                                     "use-sampler", "useSampler", this.on_settings_changed, null);
 
             this.chartElements = [];
             this.lastOutput = "";
@@ -114,7 +127,9 @@ CmdChartApplet.prototype = {
             prefsItem.connect('activate', Lang.bind(this, this.openPreferences));
             this.menu.addMenuItem(prefsItem);
 
-            this.executeCommand();
+            if (!this.useSampler) {
+                this.executeCommand();
+            }
             this.setupTimer();
 
         } catch (e) {
@@ -122,21 +137,63 @@ CmdChartApplet.prototype = {
         }
     },
 
-    // Log only if verbose logging is enabled in settings
+    // Log only if verbose logging is enabled in settings. Pass a function
+    // for messages that are costly to build, it is called only when logged
     log: function(message) {
         if (this.verboseLogging) {
+            if (typeof message === "function") {
+                message = message();
+            }
             global.log(this.uuid + ": " + message);
         }
     },
 
-    // Always log errors, regardless of settings
+    // Always log warnings and errors, regardless of settings, but the
+    // same message only LOG_REPEAT_BURST times per LOG_REPEAT_WINDOW
+    warn: function(message) {
+        this.logRepeated(global.logWarning, " WARNING: ", message);
+    },
+
     error: function(message) {
-        global.logError(this.uuid + " ERROR: " + message);
+        this.logRepeated(global.logError, " ERROR: ", message);
+    },
+
+    logRepeated: function(logFunc, label, message) {
+        if (typeof message === "function") {
+            message = message();
+        }
+        message = String(message);
+        let now = GLib.get_monotonic_time() / 1000000;
+        if (!this.logRepeats) {
+            this.logRepeats = new Map();
+        }
+        let state = this.logRepeats.get(message);
+        if (!state || now - state.since >= LOG_REPEAT_WINDOW) {
+            if (state && state.count > LOG_REPEAT_BURST) {
+                logFunc(this.uuid + label + (state.count - LOG_REPEAT_BURST) +
+                        " repeats suppressed: " + message);
+            }
+            if (this.logRepeats.size >= LOG_REPEAT_KEYS) {
+                this.logRepeats.clear();
+            }
+            state = {since: now, count: 0};
+            this.logRepeats.set(message, state);
+        }
+        state.count++;
+        if (state.count <= LOG_REPEAT_BURST) {
+            logFunc(this.uuid + label + message);
+        }
     },
 
     setupTimer: function() {
         if (this.timeout) {
             Mainloop.source_remove(this.timeout);
+            this.timeout = null;
+        }
+        this.disconnectSampler();
+        if (this.useSampler && !this.samplerFailed) {
+            this.connectSampler(SAMPLER_CONNECT_RETRIES);
+            return;
         }
         let intervalSeconds = this.updateInterval || 60;
         this.timeout = Mainloop.timeout_add_seconds(intervalSeconds, Lang.bind(this, this.executeCommand));
@@ -148,9 +205,130 @@ CmdChartApplet.prototype = {
 
     on_settings_changed: function() {
         this.log("CMD Chart Applet: Settings changed");
+        this.samplerFailed = false;
         this.setupTimer();
         this.rebuildPanelChart();
-        this.executeCommand();
+        if (!this.useSampler) {
+            this.executeCommand();
+        }
+    },
+
+    // Shared sampler socket, see cmd-chart-sampler.py
+    samplerSocketPath: function() {
+        return GLib.get_user_runtime_dir() + "/cmd-chart-applet/sampler.sock";
+    },
+
+    connectSampler: function(retries) {
+        this.samplerRetry = null;
+        let address = Gio.UnixSocketAddress.new(this.samplerSocketPath());
+        let client = new Gio.SocketClient();
+        client.connect_async(address, null, (obj, res) => {
+            try {
+                this.samplerConnection = obj.connect_finish(res);
+            } catch (e) {
+                if (retries === SAMPLER_CONNECT_RETRIES) {
+                    this.spawnSampler();
+                }
+                if (retries > 0) {
+                    this.samplerRetry = Mainloop.timeout_add(SAMPLER_RETRY_DELAY,
+                        () => { this.connectSampler(retries - 1); return false; });
+                } else {
+                    this.error("CMD Chart Applet: Shared sampler unavailable, running locally");
+                    this.samplerFailed = true;
+                    this.setupTimer();
+                    this.executeCommand();
+                }
+                return;
+            }
+            let request = JSON.stringify({
+                command: this.command || 'echo "CR:g"',
+                interval: this.updateInterval || 60,
+                timeout: this.commandTimeout || 10
+            }) + "\n";
+            this.samplerConnection.get_output_stream().write_all(
+                ByteArray.fromString(request), null);
+            this.samplerInput = new Gio.DataInputStream({
+                base_stream: this.samplerConnection.get_input_stream()
+            });
+            this.log("CMD Chart Applet: Subscribed to the shared sampler");
+            this.readSamplerLine();
+        });
+    },
+
+    spawnSampler: function() {
+        let script = this.appletPath + "/cmd-chart-sampler.py";
+        this.log("CMD Chart Applet: Starting shared sampler " + script);
+        try {
+            Util.spawn(['python3', script]);
+        } catch (e) {
+            this.error("CMD Chart Applet: Failed to start shared sampler: " + e);
+        }
+    },
+
+    readSamplerLine: function() {
+        let input = this.samplerInput;
+        input.read_line_async(GLib.PRIORITY_DEFAULT, null, (stream, res) => {
+            if (input !== this.samplerInput) {
+                return;
+            }
+            let line = null;
+            try {
+                [line] = stream.read_line_finish_utf8(res);
+            } catch (e) {
+                this.error("CMD Chart Applet: Sampler read error: " + e);
+            }
+            if (line === null) {
+                this.log("CMD Chart Applet: Shared sampler went away, reconnecting");
+                this.disconnectSampler();
+                this.samplerRetry = Mainloop.timeout_add_seconds(1,
+                    () => { this.connectSampler(SAMPLER_CONNECT_RETRIES); return false; });
+                return;
+            }
+            try {
+                this.onSamplerMessage(JSON.parse(line));
+            } catch (e) {
+                this.error("CMD Chart Applet: Bad sampler message: " + e);
+            }
+            this.readSamplerLine();
+        });
+    },
+
+    onSamplerMessage: function(message) {
+        if (message.history !== undefined) {
+            // The sampler owns the history of shared commands
+            this.history = [];
+            this.replaying = true;
+            for (let output of message.history) {
+                this.parseCommandOutput(output);
+            }
+            this.replaying = false;
+        } else if (message.output !== undefined) {
+            this.showOutput(message.output);
+        } else if (message.error !== undefined) {
+            this.error("CMD Chart Applet: Command error: " + message.error);
+        }
+    },
+
+    disconnectSampler: function() {
+        if (this.samplerRetry) {
+            Mainloop.source_remove(this.samplerRetry);
+            this.samplerRetry = null;
+        }
+        if (this.samplerConnection) {
+            this.samplerConnection.close(null);
+            this.samplerConnection = null;
+        }
+        this.samplerInput = null;
+    },
+
+    showOutput: function(output) {
+        this.lastOutput = output.trim();
+        this.chartElements = this.parseCommandOutput(this.lastOutput);
+
+        if (this.panelChartActor) {
+            this.panelChartActor.queue_repaint();
+        }
+        this.set_applet_tooltip(_("CMD: " + this.lastOutput));
     },
 
     rebuildPanelChart: function() {
@@ -330,9 +508,11 @@ CmdChartApplet.prototype = {
                             this.history.shift();
                         }
                         // Append only the new value to the history file
-                        this.appendToFile(
-                            this.historyFilePath,
-                            value.toString() + '\n');
+                        if (!this.replaying) {
+                            this.appendToFile(
+                                this.historyFilePath,
+                                value.toString() + '\n');
+                        }
                         this.graphColor = color;
                     }
                     if (parts.length > 3) {
@@ -350,7 +530,7 @@ CmdChartApplet.prototype = {
         try {
             let cmd = this.command || 'echo "CR:g"';
 
-            this.log("CMD Chart Applet: Executing async command: " + cmd);
+            this.log(() => "CMD Chart Applet: Executing async command: " + cmd);
 
             // Split the command string into an array for Gio.Subprocess
             let [success, argv] = GLib.shell_parse_argv(cmd);
@@ -366,8 +546,20 @@ CmdChartApplet.prototype = {
 
             proc.init(null);
 
+            // Kill the command when it runs longer than the timeout
+            let timeoutId = Mainloop.timeout_add_seconds(this.commandTimeout || 10, () => {
+                timeoutId = null;
+                this.error("CMD Chart Applet: Command timeout: " + cmd);
+                proc.force_exit();
+                return false;
+            });
+
             // Run the process and capture output asynchronously
             proc.communicate_utf8_async(null, null, (obj, res) => {
+                if (timeoutId) {
+                    Mainloop.source_remove(timeoutId);
+                    timeoutId = null;
+                }
                 try {
                     let [success, stdout, stderr] = obj.communicate_utf8_finish(res);
 
@@ -376,13 +568,7 @@ CmdChartApplet.prototype = {
                     }
 
                     if (success && stdout) {
-                        this.lastOutput = stdout.trim();
-                        this.chartElements = this.parseCommandOutput(this.lastOutput);
-
-                        if (this.panelChartActor) {
-                            this.panelChartActor.queue_repaint();
-                        }
-                        this.set_applet_tooltip(_("CMD: " + this.lastOutput));
+                        this.showOutput(stdout);
                     }
                 } catch (e) {
                     this.error("CMD Chart Applet Callback Error: " + e);
@@ -415,7 +601,7 @@ CmdChartApplet.prototype = {
         }
 
         let num_lines = this.chartElements.length;
-        this.log("CMD Chart Applet: draw lines: " + num_lines);
+        this.log(() => "CMD Chart Applet: draw lines: " + num_lines);
 
         let spacing = 4;
         let currentX = spacing;
@@ -428,17 +614,17 @@ CmdChartApplet.prototype = {
             let y_offset = l * lineHeight;
             let line = this.chartElements[l];
             currentX = spacing;
-            this.log("CMD Chart Applet: line "+ l + ": " + JSON.stringify(line));
+            this.log(() => "CMD Chart Applet: line "+ l + ": " + JSON.stringify(line));
             for (let i = 0; i < line.length; i++) {
                 let element = line[i];
-                this.log("CMD Chart Applet: line " + l + " element "+ i + ": " + JSON.stringify(element));
+                this.log(() => "CMD Chart Applet: line " + l + " element "+ i + ": " + JSON.stringify(element));
                 if (element.type === 'circle') {
                     let radius = Math.min(lineHeight / 2 - 2, 10);
                     let centerX = currentX + radius;
                     let centerY = y_offset + lineHeight / 2;
 
                     if (centerX + radius + overflowIndicatorWidth > width) {
-                        this.log(
+                        this.log(() =>
                             "CMD Chart Applet: Out of space for circle at element " +
                             i +
                             "/" +
@@ -552,7 +738,7 @@ CmdChartApplet.prototype = {
                     let textY = y_offset + lineHeight / 2 + textHeight / 2;
 
                     if (textX + textWidth + overflowIndicatorWidth > width) {
-                        this.log("CMD Chart Applet: Out of space for text '" + 
+                        this.log(() => "CMD Chart Applet: Out of space for text '" + 
                             element.text + 
                             "', line " +
                             l +
@@ -573,7 +759,7 @@ CmdChartApplet.prototype = {
         }
 
         if (drawnElements < this.chartElements.length) {
-            this.error("CMD Chart Applet: WARNING - Not all elements fit! Increase chart width in settings.");
+            this.warn("CMD Chart Applet: Not all elements fit! Increase chart width in settings.");
         }
 
         if (hasOverflow && currentX < width) {
@@ -647,6 +833,7 @@ CmdChartApplet.prototype = {
         if (this.timeout) {
             Mainloop.source_remove(this.timeout);
         }
+        this.disconnectSampler();
     }
 };
 
@@ -26,6 +26,7 @@ echo "Copying applet files..."
 cp "$SCRIPT_DIR/$APPLET_UUID/applet.js" "$APPLET_DIR/"
 cp "$SCRIPT_DIR/$APPLET_UUID/metadata.json" "$APPLET_DIR/"
 cp "$SCRIPT_DIR/$APPLET_UUID/settings-schema.json" "$APPLET_DIR/"
+cp "$SCRIPT_DIR/mate/cmd-chart-sampler.py" "$APPLET_DIR/"
 
 echo "Installation completed successfully!"
 echo
@@ -6,6 +6,7 @@ pushd mate || { echo "No mate directory! Exiting."; exit 1; }
 
 # Copy files to system directories
 sudo cp cmd-chart-applet.py /usr/lib/mate-applets/
+sudo cp cmd-chart-sampler.py /usr/lib/mate-applets/
 sudo cp org.mate.panel.CmdChartApplet.mate-panel-applet /usr/share/mate-panel/applets/
 sudo cp cmd-chart-applet.desktop /usr/share/applications/
 sudo cp org.mate.panel.applet.CmdChartAppletFactory.service /usr/share/dbus-1/services/
@@ -14,6 +15,7 @@ sudo glib-compile-schemas /usr/share/glib-2.0/schemas/
 
 # Set proper permissions
 sudo chmod +x /usr/lib/mate-applets/cmd-chart-applet.py
+sudo chmod +x /usr/lib/mate-applets/cmd-chart-sampler.py
 
 echo "Installation complete!"
 echo "Restart MATE panel: mate-panel --replace &"
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""Headless benchmarks of the applet hot paths
+
+Drives parse_output, on_draw, draw_graph and the graph history of a real
+CmdChartApplet against a cairo.ImageSurface. The panel applet is replaced
+by a plain Gtk.EventBox and the settings use the GSettings memory
+backend with the schema compiled into a temporary directory, so nothing
+touches dconf or the running panel.
+
+    python3 mate/benchmarks/bench_applet.py [--only NAME] [--seconds N]
+    python3 mate/benchmarks/bench_applet.py --save-baseline
+    python3 mate/benchmarks/bench_applet.py --check
+
+Results are compared with baseline.json next to this script when it
+exists; --check exits with status 1 when a benchmark got slower than the
+tolerance. Needs python3-gi, python3-cairo, glib-compile-schemas and a
+display (use xvfb-run on a headless machine).
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench_parse import (compare, load_applet, load_baseline, make_frames,
+                         save_baseline)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_XML = os.path.join(HERE, "..",
+                          "org.mate.panel.applet.CmdChartApplet.gschema.xml")
+PREFS_PATH = "/org/mate/panel/objects/bench/prefs/"
+WIDTH = 200
+HEIGHT = 24
+EMOJI = "🔥💾🌡️📶🔋⚡🖥️🐧"
+
+
+def memory_settings(applet, workdir):
+    """GSettings on the memory backend with the schema from the tree"""
+    Gio = applet.Gio
+    shutil.copy(SCHEMA_XML, workdir)
+    subprocess.run(["glib-compile-schemas", workdir], check=True)
+    source = Gio.SettingsSchemaSource.new_from_directory(
+        workdir, Gio.SettingsSchemaSource.get_default(), False)
+    schema = source.lookup(applet.SCHEMA_ID, False)
+    return Gio.Settings.new_full(schema, Gio.memory_settings_backend_new(),
+                                 PREFS_PATH)
+
+
+def make_applet(applet, workdir):
+    """CmdChartApplet on a stand-in panel applet, sampling stopped"""
+    Gtk = applet.Gtk
+
+    class BenchApplet(Gtk.EventBox):
+        """Stand-in for MatePanelApplet.Applet"""
+
+        def get_preferences_path(self):
+            return PREFS_PATH
+
+        def get_size(self):
+            return HEIGHT
+
+        def setup_menu(self, xml, action_group):
+            pass
+
+    settings = memory_settings(applet, workdir)
+    settings.set_string("command", "true")
+    settings.set_int("chart-width", WIDTH)
+    applet.Gio.Settings.new_with_path = staticmethod(
+        lambda schema_id, path: settings)
+    applet.HISTORY_DIR = os.path.join(workdir, "history")
+    os.makedirs(applet.HISTORY_DIR)
+
+    chart = applet.CmdChartApplet(BenchApplet())
+    chart.stop_sampling()
+    chart.session.stop()
+    return chart
+
+
+class Allocation():
+    width = WIDTH
+    height = HEIGHT
+
+
+class Widget():
+    """What on_draw needs from the drawing area"""
+
+    @staticmethod
+    def get_allocation():
+        return Allocation()
+
+
+def text_frames(count):
+    """Long runs of TXT/TXTC elements, two lines"""
+    rng = random.Random(2)
+    return [" || ".join(
+        " | ".join(f"TXTC:#{rng.randrange(0x1000):03x}:item {i} "
+                   f"{rng.uniform(0, 100):.1f}%" for i in range(40))
+        for _ in range(2)) for _ in range(count)]
+
+
+def emoji_frames(count):
+    rng = random.Random(3)
+    return [" | ".join(f"TXT:{rng.choice(EMOJI)} {rng.randint(0, 99)}"
+                       for _ in range(12)) for _ in range(count)]
+
+
+def all_elements_frames(count):
+    """Every element kind on 3 lines, named graph series included"""
+    rng = random.Random(4)
+    frames = []
+    for _ in range(count):
+        cpu = rng.uniform(0, 100)
+        frames.append(
+            f"CR:g | BAR:0-100={cpu:.0f}:k:r | HBAR:0-5={cpu / 20:.2f}:o || "
+            f"TXT:cpu {cpu:.0f}% | TXTC:#29c:net {rng.randint(0, 999)}k || "
+            f"CR:#f80 | TXT:ok | GR.cpu:r:{cpu:.1f}:0:100 | "
+            f"GR.io:b:{rng.uniform(0, 50):.1f}")
+    return frames
+
+
+def new_context(applet):
+    cairo = applet.cairo
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    return cairo.Context(surface)
+
+
+def bench_parse(chart, frames):
+    def op(i):
+        chart.parse_output(frames[i % len(frames)])
+    return op
+
+
+def bench_draw(applet, chart, frames, cold):
+    """Apply a new frame and draw it; cold drops the layer cache too"""
+    cr = new_context(applet)
+    widget = Widget()
+
+    def op(i):
+        chart.apply_output(frames[i % len(frames)])
+        # No main loop runs, present the frame right away
+        if chart.tick_id is not None:
+            chart.drawing_area.remove_tick_callback(chart.tick_id)
+        chart.on_frame_tick(None, None)
+        if cold:
+            chart.layers.clear()
+        chart.on_draw(widget, cr)
+    return op
+
+
+def bench_graph(applet, chart, points):
+    """Geometry and drawing of a long history, as after every sample"""
+    chart.settings.set_int("history-len", points)
+    chart.on_history_len_changed(chart.settings, "history-len")
+    rng = random.Random(5)
+    for _ in range(points):
+        for name in ("", "io"):
+            chart.add_graph_value(applet.Element(
+                'GR', (0, 1, 0), value=rng.uniform(0, 100), text=name),
+                persist=False)
+    cr = new_context(applet)
+
+    def op(i):
+        chart.graph_version += 1
+        chart.draw_graph(cr, WIDTH, HEIGHT)
+    return op
+
+
+def bench_history(applet, chart):
+    """Append persisted values to the history and its rollups"""
+    element = applet.Element('GR', (0, 1, 0), value=1.0, text="hist")
+
+    def op(i):
+        chart.add_graph_value(element._replace(value=float(i % 100)))
+    return op
+
+
+def measure(op, seconds):
+    """(ops/sec, mean peak KiB allocated during one op)"""
+    for i in range(10):
+        op(i)
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for i in range(count, count + 10):
+            op(i)
+        count += 10
+    rate = count / (time.perf_counter() - start)
+
+    runs = max(1, min(count, 100))
+    total = 0
+    tracemalloc.start()
+    for i in range(runs):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        op(i)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return rate, total / runs / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--only", help="run benchmarks containing NAME")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--history", type=int, default=100000,
+                        help="points in the graph benchmark")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    applet = load_applet()
+    with tempfile.TemporaryDirectory() as workdir:
+        chart = make_applet(applet, workdir)
+        mixed = make_frames(50, 20)
+        benchmarks = [
+            ("parse-mixed", lambda: bench_parse(chart, mixed)),
+            ("parse-text", lambda: bench_parse(chart, text_frames(20))),
+            ("parse-emoji", lambda: bench_parse(chart, emoji_frames(20))),
+            ("draw-cold", lambda: bench_draw(
+                applet, chart, all_elements_frames(20), True)),
+            ("draw-warm", lambda: bench_draw(
+                applet, chart, all_elements_frames(20), False)),
+            ("draw-text", lambda: bench_draw(
+                applet, chart, text_frames(20), True)),
+            ("graph", lambda: bench_graph(applet, chart, args.history)),
+            ("history", lambda: bench_history(applet, chart)),
+        ]
+
+        baseline = load_baseline()
+        results = {}
+        regressions = []
+        for name, setup in benchmarks:
+            if args.only and args.only not in name:
+                continue
+            rate, kib = measure(setup(), args.seconds)
+            results[name] = {"ops": rate, "kib": kib}
+            text, regressed = compare(name, rate, baseline,
+                                      args.tolerance)
+            if regressed:
+                regressions.append(name)
+            print(f"{name:>12}: {rate:12.1f} ops/s {kib:10.2f} KiB/op"
+                  f"{text}", flush=True)
+        chart.on_applet_removed_from_panel()
+
+    if args.save_baseline:
+        save_baseline(baseline, results)
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the command output parser
+
+Parses large multi-line ('||') outputs with the current parser and with
+the previous regex based one, and prints throughput for both. Only
+parsing is timed: history writes are measured by the 'history' case of
+bench_applet.py.
+
+    python3 mate/benchmarks/bench_parse.py [--lines N] [--repeat N]
+    python3 mate/benchmarks/bench_parse.py --save-baseline
+    python3 mate/benchmarks/bench_parse.py --check
+
+The current parser is compared with the 'parse-frame' entry of
+baseline.json next to this script (shared with bench_applet.py);
+--check exits with status 1 when it got slower than the tolerance.
+Needs the applet runtime dependencies (python3-gi, python3-cairo).
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APPLET = os.path.join(HERE, "..", "cmd-chart-applet.py")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+
+def load_applet():
+    spec = importlib.util.spec_from_file_location("cmd_chart_applet",
+                                                  APPLET)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LegacyParser():
+    """The parser as it was before the tokenizer, for comparison
+
+    A port of the old CmdChartApplet.parse_output: the regex split, the
+    unconditionally formatted debug messages and, for every GR token, the
+    history list trim. The append to the text history file is left out
+    and the history-len GSettings lookup is replaced by a constant.
+    """
+
+    def __init__(self, history_len=16):
+        self.history = []
+        self.history_len = history_len
+        self.graph_min = None
+        self.graph_max = None
+        self.graph_color = None
+        self.do_draw_graph = False
+
+    def log(self, text, force=False):
+        pass
+
+    def parse_output(self, output):
+        if not output:
+            return []
+        parsed_lines = []
+        for line in output.split('||'):
+            line = line.strip()
+            parsed_elements = []
+            if not line:
+                parsed_lines.append([])
+                continue
+            parts = re.split(r'(?:[^\\])\| *', line)
+            self.log(f"PARTS: {parts}")
+            for part in parts:
+                if part.startswith('CR:'):
+                    try:
+                        parsed_elements.append(
+                            {'type': 'CIRCLE', 'color': part.split(':')[1]})
+                    except Exception:
+                        self.log(f"Failed to parse {part}", True)
+                elif part.startswith('BAR:') or part.startswith('HBAR:'):
+                    try:
+                        info = part.split(':')
+                        range_part, val_part = info[1].split('=')
+                        min_val, max_val = map(int, range_part.split('-'))
+                        parsed_elements.append({
+                            'type': 'HBAR' if part[0] == 'H' else 'BAR',
+                            'range': (min_val, max_val),
+                            'value': float(val_part),
+                            'colors': info[2:] if len(info) > 2 else ['g']})
+                    except Exception:
+                        self.log(f"Failed to parse {part}", True)
+                elif part.startswith('TXTC:'):
+                    try:
+                        [_, color, text] = part.split(':', 3)
+                    except Exception:
+                        self.log(f"Failed to parse {part}", True)
+                        color = "#eee"
+                        text = "Parse error"
+                    parsed_elements.append(
+                        {'type': 'TXT', 'text': text, 'color': color})
+                elif part.startswith('TXT:'):
+                    try:
+                        text = part.split(':', 1)[1].replace('\\|', '|')
+                    except Exception:
+                        self.log(f"Failed to parse {part}", True)
+                        text = "Parse error"
+                    parsed_elements.append(
+                        {'type': 'TXT', 'text': text, 'color': None})
+                elif part.startswith('GR:'):
+                    try:
+                        values = part[3:].split(':')
+                        color, value_str = values[0:2]
+                        value = float(value_str)
+                        if len(values) == 4:
+                            self.graph_min = float(values[2])
+                            self.graph_max = float(values[3])
+                        self.history.append(value)
+                        if len(self.history) > self.history_len:
+                            self.history.pop(0)
+                        self.graph_color = color
+                        self.do_draw_graph = True
+                    except Exception as e:
+                        self.log(f"Failed to parse GR token: {e}", True)
+            if parsed_elements:
+                parsed_lines.append(parsed_elements)
+        self.log(f"Parsed data: {parsed_lines}")
+        return parsed_lines
+
+
+def load_baseline():
+    """Saved results by benchmark name, {} when there are none"""
+    try:
+        with open(BASELINE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(baseline, results):
+    baseline.update(results)
+    with open(BASELINE, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Baseline saved to {BASELINE}")
+
+
+def compare(name, rate, baseline, tolerance):
+    """(text, regressed) for a rate in ops/s against the baseline"""
+    if name not in baseline:
+        return "", False
+    ratio = rate / baseline[name]["ops"]
+    if ratio < 1 - tolerance:
+        return f"  {ratio:6.2f}x baseline  REGRESSION", True
+    return f"  {ratio:6.2f}x baseline", False
+
+
+def make_frames(lines, count):
+    """Distinct frames, values change from frame to frame like real data"""
+    rng = random.Random(1)
+    frames = []
+    for _ in range(count):
+        out = []
+        for _ in range(lines):
+            cpu = rng.uniform(0, 100)
+            load = rng.uniform(0, 5)
+            out.append(f"CR:g | BAR:0-100={cpu:.1f}:k:g | "
+                       f"HBAR:0-5={load:.2f}:o | TXT:Load {load:.2f} | "
+                       f"TXTC:#29c:Temp: {rng.randint(30, 90)}°C | "
+                       f"GR:g:{cpu:.1f}:0:100")
+        frames.append(" || ".join(out))
+    return frames
+
+
+def bench(name, func, frames, repeat):
+    for output in frames:
+        func(output)
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(frames[i % len(frames)])
+    elapsed = time.perf_counter() - start
+    size = len(frames[0].encode()) * repeat / 1024 / 1024
+    print(f"{name:>8}: {repeat / elapsed:10.1f} frames/s "
+          f"{size / elapsed:8.2f} MB/s "
+          f"{elapsed / repeat * 1e6:10.1f} us/frame", end="")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    applet = load_applet()
+    frames = make_frames(args.lines, args.frames)
+    print(f"{args.lines} lines, {len(frames[0])} bytes per frame, "
+          f"{len(frames)} distinct frames")
+
+    log = applet.Logger()
+    legacy = LegacyParser()
+    baseline = load_baseline()
+    new = bench("current", lambda text: applet.parse_frame(text, log),
+                frames, args.repeat)
+    # The baseline holds the default sizes only
+    default = (args.lines, args.frames) == (200, 20)
+    rate = args.repeat / new
+    text, regressed = compare("parse-frame", rate, baseline,
+                              args.tolerance) if default else ("", False)
+    print(text)
+    old = bench("legacy", legacy.parse_output, frames, args.repeat)
+    print()
+    print(f"speedup: {old / new:.2f}x")
+
+    if args.save_baseline and default:
+        save_baseline(baseline, {"parse-frame": {"ops": rate}})
+    if args.check and regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
 import subprocess
-import traceback
 import sys
 import signal
 import re
 import os
 import math
+import json
+import mmap
+import struct
+import time
+import operator
+from array import array
+from collections import OrderedDict, deque
+from typing import NamedTuple
 # import json
 # import os
 
@@ -16,19 +23,2950 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
 gi.require_version('MatePanelApplet', '4.0')
 gi.require_version("GLib", "2.0")
+gi.require_version('PangoCairo', '1.0')
 from gi.repository import Gtk, Gdk, MatePanelApplet  # pyright: ignore[reportAttributeAccessIssue] # noqa: E402,E501
 from gi.repository import GLib   # pyright: ignore[reportAttributeAccessIssue] # noqa: E402,E501
 from gi.repository import Gio    # pyright: ignore[reportAttributeAccessIssue] # noqa: E402,E501
 from gi.repository import Pango  # pyright: ignore[reportAttributeAccessIssue] # noqa: E402,E501
+from gi.repository import PangoCairo  # pyright: ignore[reportAttributeAccessIssue] # noqa: E402,E501
 
 
 SCHEMA_ID = "org.mate.panel.applet.CmdChartApplet"
+READ_CHUNK = 65536
+STREAM_MAX_LINE = 1024 * 1024
+STREAM_BACKOFF_MIN = 1
+STREAM_BACKOFF_MAX = 60
+STREAM_STABLE_RUN = 30
+RESTART_DELAY = 1000
+SCHED_MIN_INTERVAL = 0.05
+SCHED_BACKOFF_AFTER = 3
+SCHED_BACKOFF_MAX = 8
+SCHED_BACKOFF_LIMIT = 600
+# Pause reasons that only apply with adaptive polling on
+SCHED_ADAPTIVE_PAUSES = frozenset({"idle"})
+BREAKER_THRESHOLD = 3
+BREAKER_MAX_FACTOR = 32
+BREAKER_LIMIT = 1800
+BUDGET_RUNS = 20
+COPROC_SHELL = "/bin/sh"
+COPROC_MAX_RUNS = 1000
+SESSION_STATUS_IDLE = 3
+LOGIND_SESSION = "org.freedesktop.login1.Session"
+SOURCE_WORKERS = 4
+PUSH_RATE = 20
+PUSH_BURST = 10
+PUSH_MAX_CLIENTS = 8
+STATS_SAMPLES = 256
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVEL_NAMES = {LOG_DEBUG: "DEBUG", LOG_INFO: "INFO",
+                   LOG_WARNING: "WARNING", LOG_ERROR: "ERROR"}
+LOG_RING_SIZE = 500
+LOG_REPEAT_BURST = 5
+LOG_REPEAT_WINDOW = 60
+LOG_REPEAT_KEYS = 256
+LOG_TRACEBACK_LINES = 20
+STATS_WRITE_DELAY = 10
+TOOLTIP_MAX_CHARS = 2000
+TOOLTIP_OUTPUT_LINES = 12
+TOOLTIP_SAMPLES = 5
+BUILTIN_PREFIX = "builtin:"
+PLUGIN_PREFIX = "python:"
+PLUGIN_GROUP = "cmd_chart_applet.sources"
+PLUGIN_DIR = "~/.config/cmd-chart-applet/plugins"
+PLUGIN_WORKERS = 2
+SAMPLER_SCRIPT = "cmd-chart-sampler.py"
+SAMPLER_CONNECT_RETRIES = 10
+SAMPLER_RETRY_DELAY = 300
+TEXT_CACHE_SIZE = 256
+HISTORY_DIR = "~/.local/share/mate-applets/cmd-applet"
+LEGACY_HISTORY = "history.txt"
+HISTORY_MAGIC = b"CCAH"
+HISTORY_VERSION = 1
+HISTORY_HEADER = struct.Struct("<4sIIII12x")
+HISTORY_RECORD = struct.Struct("<dd")
+HISTORY_FLUSH_DELAY = 30
+LEGACY_TAIL_BYTES = 64 * 1024
+HISTORY_MAX = 100000
+# Named GR series per instance, unused ones expire with the month span
+SERIES_MAX = 16
+SERIES_EXPIRE = 30 * 24 * 3600
+ROLLUP_MAGIC = b"CCAR"
+ROLLUP_RECORD = struct.Struct("<ddddd")
+# Graph span: (bucket seconds, buckets kept), raw uses the plain history
+ROLLUP_TIERS = OrderedDict([
+    ("day", (60, 1440)),
+    ("week", (900, 672)),
+    ("month", (3600, 720)),
+])
+
+
+class Logger():
+    """Leveled log kept in a bounded ring, formatted only when enabled
+
+    Messages take %-style args like the logging module, so a disabled
+    DEBUG call costs no formatting. DEBUG is only recorded with verbose
+    on. WARNING and ERROR are printed (to the panel's journal), INFO and
+    DEBUG only with verbose on. From INFO up the same message (after
+    formatting) is kept at most LOG_REPEAT_BURST times per
+    LOG_REPEAT_WINDOW seconds. exception() adds the tail of the current
+    traceback to an ERROR.
+
+    Calling the logger, log(text, force), is the short form: INFO with
+    force, DEBUG without.
+    """
+
+    def __init__(self, size=LOG_RING_SIZE):
+        self.verbose = False
+        self.ring = deque(maxlen=size)
+        self.repeats = {}
+
+    def __call__(self, text, force=False):
+        self.emit(LOG_INFO if force else LOG_DEBUG, text, ())
+
+    def debug(self, msg, *args):
+        if self.verbose:
+            self.emit(LOG_DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.emit(LOG_INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.emit(LOG_WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self.emit(LOG_ERROR, msg, args)
+
+    def exception(self, msg, *args):
+        """ERROR with the traceback of the exception being handled"""
+        if self.emit(LOG_ERROR, msg, args):
+            import traceback
+            lines = traceback.format_exc().rstrip().splitlines()
+            if len(lines) > LOG_TRACEBACK_LINES:
+                lines = ["..."] + lines[-LOG_TRACEBACK_LINES:]
+            self.record(LOG_ERROR, "\n".join(lines))
+
+    def emit(self, level, msg, args):
+        """Record a message, returns False when it was dropped"""
+        if level < LOG_INFO:
+            if self.verbose:
+                self.record(level, msg % args if args else msg)
+            return self.verbose
+        text = msg % args if args else msg
+        now = time.monotonic()
+        state = self.repeats.get(text)
+        if state is None or now - state[0] >= LOG_REPEAT_WINDOW:
+            if state and state[1] > LOG_REPEAT_BURST:
+                self.record(level, f"{state[1] - LOG_REPEAT_BURST} repeats "
+                                   f"suppressed: {text}")
+            if len(self.repeats) >= LOG_REPEAT_KEYS:
+                self.repeats.clear()
+            state = self.repeats[text] = [now, 0]
+        state[1] += 1
+        if state[1] > LOG_REPEAT_BURST:
+            return False
+        self.record(level, text)
+        return True
+
+    def record(self, level, text):
+        entry = (time.time(), level, text)
+        self.ring.append(entry)
+        if level >= LOG_WARNING or self.verbose:
+            print(self.format(entry), flush=True)
+
+    @staticmethod
+    def format(entry):
+        stamp, level, text = entry
+        return (f"{time.strftime('%H:%M:%S', time.localtime(stamp))} "
+                f"{LOG_LEVEL_NAMES[level]} {text}")
+
+    def dump(self):
+        """Recent entries, oldest first"""
+        return "\n".join(self.format(entry) for entry in self.ring)
+
+
+def kill_group(proc):
+    """Kill a command started in its own session with all it spawned"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+
+class CommandRunner():
+    """Run a shell command asynchronously on the GLib main loop
+
+    Output is read from a non-blocking pipe watched by the main loop, so a
+    slow command never freezes the panel. The command runs in its own
+    session; a timeout kills the whole process group, so children of the
+    shell (a hung curl, say) do not outlive it. The callback receives
+    (output, error) where error is None on success. Wall time (ms) and
+    exit status of the last run are left in duration and status, its
+    resource usage as (CPU seconds, max RSS KiB) in usage.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.proc = None
+        self.chunks = []
+        self.callback = None
+        self.watch_id = None
+        self.timeout_id = None
+        self.reap_id = None
+        self.started = 0
+        self.duration = None
+        self.status = None
+        self.usage = None
+
+    @property
+    def busy(self):
+        """True while a sample is in flight"""
+        return self.proc is not None
+
+    def start(self, command, timeout, callback):
+        """Spawn the command, callback is called when it finishes"""
+        if self.busy:
+            return False
+        self.chunks = []
+        self.callback = callback
+        self.started = GLib.get_monotonic_time()
+        self.duration = None
+        self.status = None
+        self.usage = None
+        try:
+            self.proc = subprocess.Popen(
+                command,
+                shell=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+                start_new_session=True)
+        except Exception as e:
+            self.proc = None
+            GLib.idle_add(self.deliver, "", str(e))
+            return False
+
+        fd = self.proc.stdout.fileno()
+        os.set_blocking(fd, False)
+        self.watch_id = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.on_readable)
+        self.timeout_id = GLib.timeout_add_seconds(
+            max(1, timeout), self.on_timeout)
+        return True
+
+    def on_readable(self, fd, condition):
+        """Drain the pipe, finish on EOF"""
+        while True:
+            try:
+                chunk = os.read(fd, READ_CHUNK)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                self.log.error("Read error: %s", e)
+                chunk = b""
+            if not chunk:
+                self.watch_id = None
+                self.stop_timeout()
+                self.proc.stdout.close()
+                self.reap()
+                return False
+            self.chunks.append(chunk)
+
+    def reap(self):
+        """Wait for the process exit without blocking the main loop
+
+        wait4 also gives the rusage of the shell and the children it
+        waited for.
+        """
+        self.reap_id = None
+        try:
+            pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid, rusage = self.proc.pid, None
+            self.proc.poll()
+        if pid == 0:
+            self.reap_id = GLib.timeout_add(20, self.reap)
+            return False
+        if rusage is not None:
+            self.proc.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = (rusage.ru_utime + rusage.ru_stime,
+                          rusage.ru_maxrss)
+        output = b"".join(self.chunks).decode(errors="replace").strip()
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        self.status = self.proc.returncode
+        self.proc = None
+        self.chunks = []
+        self.deliver(output, None)
+        return False
+
+    def on_timeout(self):
+        """Kill the command when it exceeds the timeout"""
+        self.timeout_id = None
+        self.log.warning("Command timeout")
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        self.kill()
+        self.deliver("", "timeout")
+        return False
+
+    def stop_timeout(self):
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def kill(self):
+        """Kill the running process and drop its watches"""
+        for source_id in (self.watch_id, self.reap_id):
+            if source_id:
+                GLib.source_remove(source_id)
+        self.watch_id = None
+        self.reap_id = None
+        self.stop_timeout()
+        if self.proc is None:
+            return
+        proc = self.proc
+        self.proc = None
+        self.chunks = []
+        kill_group(proc)
+        try:
+            proc.stdout.close()
+        except Exception:
+            pass
+        # Reap in background to avoid zombies
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, proc.pid,
+                             lambda pid, status: None)
+
+    def cancel(self):
+        """Abort the current run without calling the callback"""
+        self.callback = None
+        self.kill()
+
+    def deliver(self, output, error):
+        callback = self.callback
+        self.callback = None
+        if callback:
+            callback(output, error)
+        return False
+
+
+class ShellCoprocess():
+    """Run commands in one long-lived shell instead of a shell per run
+
+    Same interface as CommandRunner. Every command is written to the
+    shell's stdin as `( eval '<command>' ) </dev/null`: the subshell is a
+    fork of the running shell, not a new interpreter, and keeps variables,
+    cd, traps and umask from leaking into the next run. It is followed by
+    a line with a random sentinel and the exit status, the output of
+    `times` (for the CPU used) and the sentinel again; the output is what
+    came before. A timeout or cancel kills the shell's process group;
+    a new shell is started by the next run, also after COPROC_MAX_RUNS
+    runs. Max RSS is not known per run, usage reports it as 0.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.proc = None
+        self.buffer = b""
+        self.sentinel = None
+        self.callback = None
+        self.watch_id = None
+        self.timeout_id = None
+        self.runs = 0
+        self.children_cpu = 0.0
+        self.started = 0
+        self.duration = None
+        self.status = None
+        self.usage = None
+
+    @property
+    def busy(self):
+        return self.sentinel is not None
+
+    def spawn(self):
+        self.proc = subprocess.Popen(
+            [COPROC_SHELL],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True)
+        self.runs = 0
+        self.children_cpu = 0.0
+        fd = self.proc.stdout.fileno()
+        os.set_blocking(fd, False)
+        self.watch_id = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.on_readable)
+        self.log.debug("Shell coprocess %s started", self.proc.pid)
+
+    def start(self, command, timeout, callback):
+        if self.busy:
+            return False
+        self.callback = callback
+        self.buffer = b""
+        self.started = GLib.get_monotonic_time()
+        self.duration = None
+        self.status = None
+        self.usage = None
+        sentinel = f"cca-{os.urandom(8).hex()}"
+        quoted = "'" + command.replace("'", "'\\''") + "'"
+        script = (f"( eval {quoted}\n) </dev/null\n"
+                  f"printf '\\n%s %d\\n' {sentinel} $?\n"
+                  f"times\n"
+                  f"printf '%s\\n' {sentinel}\n")
+        try:
+            if self.proc is None or self.runs >= COPROC_MAX_RUNS:
+                self.stop()
+                self.spawn()
+            self.proc.stdin.write(script.encode())
+            self.proc.stdin.flush()
+        except (OSError, ValueError) as e:
+            self.stop()
+            GLib.idle_add(self.deliver, "", str(e))
+            return False
+        self.sentinel = sentinel.encode()
+        self.runs += 1
+        self.timeout_id = GLib.timeout_add_seconds(
+            max(1, timeout), self.on_timeout)
+        return True
+
+    def on_readable(self, fd, condition):
+        while True:
+            try:
+                chunk = os.read(fd, READ_CHUNK)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.log.error("Read error: %s", e)
+                chunk = b""
+            if not chunk:
+                self.watch_id = None
+                self.log.warning("Shell coprocess exited")
+                busy = self.busy
+                self.stop()
+                if busy:
+                    self.deliver("", "shell exited")
+                return False
+            self.buffer += chunk
+        if self.busy:
+            self.check_done()
+        return True
+
+    def check_done(self):
+        """Complete the run once the closing sentinel line arrived"""
+        sentinel = self.sentinel
+        if not self.buffer.endswith(b"\n" + sentinel + b"\n"):
+            return
+        output, found, tail = self.buffer.partition(b"\n" + sentinel + b" ")
+        if not found:
+            return
+        lines = tail.decode(errors="replace").splitlines()
+        self.sentinel = None
+        self.buffer = b""
+        self.stop_timeout()
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        self.status = int(lines[0])
+        # The second line of `times` is the CPU time of the subshells
+        cpu = sum(int(minutes) * 60 + float(seconds) for minutes, seconds
+                  in re.findall(r"(\d+)m([\d.]+)s", lines[-2]))
+        self.usage = (max(0.0, cpu - self.children_cpu), 0)
+        self.children_cpu = cpu
+        self.deliver(output.decode(errors="replace").strip(), None)
+
+    def on_timeout(self):
+        """The shell is wedged on this command: kill it, a new one runs
+        the next command"""
+        self.timeout_id = None
+        self.log.warning("Command timeout")
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        self.stop()
+        self.deliver("", "timeout")
+        return False
+
+    def stop_timeout(self):
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def stop(self):
+        """Kill the shell and everything it runs"""
+        if self.watch_id:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        self.stop_timeout()
+        self.sentinel = None
+        self.buffer = b""
+        if self.proc is None:
+            return
+        proc = self.proc
+        self.proc = None
+        kill_group(proc)
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, proc.pid,
+                             lambda pid, status: None)
+
+    def cancel(self):
+        """Abort the current run and close the shell, no callback"""
+        self.callback = None
+        self.stop()
+
+    def deliver(self, output, error):
+        callback = self.callback
+        self.callback = None
+        if callback:
+            callback(output, error)
+        return False
+
+
+PLUGINS = {}
+PLUGIN_POOL = None
+
+
+def plugin_spec(command):
+    """(spec, args) of a 'python:module:function arg ...' command"""
+    spec, *args = command[len(PLUGIN_PREFIX):].split() or [""]
+    module, colon, attr = spec.partition(":")
+    if colon:
+        valid = all(name.isidentifier()
+                    for name in module.split(".") + attr.split("."))
+    else:
+        # Entry point names are free-form
+        valid = bool(spec)
+    if not valid:
+        raise ValueError(f"bad plugin '{spec}', expected module:function "
+                         "or an entry point name")
+    return spec, args
+
+
+def load_plugin(spec):
+    """Callable named 'module:function' or by a PLUGIN_GROUP entry point
+
+    Loaded once per process, PLUGIN_DIR is on the import path.
+    """
+    plugin = PLUGINS.get(spec)
+    if plugin is not None:
+        return plugin
+    import importlib
+    plugin_dir = os.path.expanduser(PLUGIN_DIR)
+    if plugin_dir not in sys.path:
+        sys.path.append(plugin_dir)
+    module, _, attr = spec.partition(":")
+    if attr:
+        plugin = importlib.import_module(module)
+        for name in attr.split("."):
+            plugin = getattr(plugin, name)
+    else:
+        from importlib.metadata import entry_points
+        found = entry_points()
+        found = found.select(group=PLUGIN_GROUP, name=spec) \
+            if hasattr(found, "select") else \
+            [ep for ep in found.get(PLUGIN_GROUP, []) if ep.name == spec]
+        if not found:
+            raise LookupError(f"no {PLUGIN_GROUP} entry point '{spec}'")
+        plugin = next(iter(found)).load()
+    if not callable(plugin):
+        raise TypeError(f"{spec} is not callable")
+    PLUGINS[spec] = plugin
+    return plugin
+
+
+def plugin_pool():
+    """Thread pool shared by the plugins of all applets in the process"""
+    global PLUGIN_POOL
+    if PLUGIN_POOL is None:
+        from concurrent.futures import ThreadPoolExecutor
+        PLUGIN_POOL = ThreadPoolExecutor(
+            max_workers=PLUGIN_WORKERS, thread_name_prefix="cmd-chart-plugin")
+    return PLUGIN_POOL
+
+
+def call_plugin(plugin, args):
+    """Run on a pool thread: (result, CPU seconds of the call)"""
+    started = time.thread_time()
+    result = plugin(*args)
+    return result, time.thread_time() - started
+
+
+def plugin_output(result, log, spec):
+    """Text stays text for the parser, Python objects shaped like a JSON
+    frame (the frame dict, a list of lines or one line of element
+    dicts) become lines of Element. spec names the plugin in errors."""
+    if result is None:
+        return ""
+    if isinstance(result, str):
+        return result
+    if isinstance(result, (list, tuple)):
+        if all(isinstance(item, dict) for item in result):
+            result = [result]
+        for line in result:
+            if not isinstance(line, (list, tuple)) or \
+                    not all(isinstance(item, dict) for item in line):
+                raise TypeError(
+                    f"plugin {spec} returned a list with "
+                    f"{type(line).__name__} {line!r:.40}, expected element "
+                    "dicts or lines (lists) of them")
+        result = {"lines": [list(line) for line in result]}
+    if isinstance(result, dict):
+        return json_frame_lines(result, log)
+    raise TypeError(f"plugin {spec} returned unsupported type "
+                    f"{type(result).__name__}")
+
+
+class PluginRunner():
+    """Call an in-process Python plugin instead of running a command
+
+    Same interface as CommandRunner. The command is
+    'python:module:function arg ...' or 'python:entry-point arg ...'; the
+    callable gets the args as strings. It runs on the plugin thread pool
+    and the result comes back to the main loop with GLib.idle_add.
+    A thread cannot be killed: on timeout the error is delivered, but
+    the runner stays busy until the call returns and its result is
+    dropped, so a hung plugin holds at most one worker.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.future = None
+        self.token = 0
+        self.spec = None
+        self.callback = None
+        self.timeout_id = None
+        self.started = 0
+        self.duration = None
+        self.status = None
+        self.usage = None
+
+    @property
+    def busy(self):
+        return self.future is not None
+
+    def start(self, command, timeout, callback):
+        if self.busy:
+            return False
+        self.callback = callback
+        self.started = GLib.get_monotonic_time()
+        self.duration = None
+        self.status = None
+        self.usage = None
+        try:
+            spec, args = plugin_spec(command)
+            plugin = load_plugin(spec)
+            self.spec = spec
+        except Exception as e:
+            self.status = 1
+            GLib.idle_add(self.deliver, "",
+                          f"cannot load plugin: {type(e).__name__}: {e}")
+            return False
+        self.token += 1
+        token = self.token
+        self.future = plugin_pool().submit(call_plugin, plugin, args)
+        self.future.add_done_callback(
+            lambda future: GLib.idle_add(self.on_done, token, future))
+        self.timeout_id = GLib.timeout_add_seconds(
+            max(1, timeout), self.on_timeout)
+        return True
+
+    def on_done(self, token, future):
+        if future is self.future:
+            self.future = None
+        if token != self.token:
+            # Timed out or cancelled, nobody waits for it
+            return False
+        self.stop_timeout()
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        try:
+            result, cpu = future.result()
+            self.usage = (cpu, 0)
+            output = plugin_output(result, self.log, self.spec)
+        except Exception as e:
+            self.status = 1
+            self.deliver("", f"{type(e).__name__}: {e}")
+            return False
+        self.status = 0
+        self.deliver(output, None)
+        return False
+
+    def on_timeout(self):
+        self.timeout_id = None
+        self.token += 1
+        self.log.warning("Command timeout")
+        self.duration = (GLib.get_monotonic_time() - self.started) / 1000
+        self.deliver("", "timeout")
+        return False
+
+    def stop_timeout(self):
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def cancel(self):
+        """Drop the current call, it still runs if it already started"""
+        self.callback = None
+        self.token += 1
+        self.stop_timeout()
+        if self.future is not None and self.future.cancel():
+            self.future = None
+
+    def deliver(self, output, error):
+        callback = self.callback
+        self.callback = None
+        if callback:
+            callback(output, error)
+        return False
+
+
+class WorkerPool():
+    """Run commands on at most `size` CommandRunners at once
+
+    Further jobs wait in FIFO order. A key that is running or already
+    waiting is not queued again, so a slow source cannot pile up runs.
+    Callbacks get (output, error, usage) with usage as CommandRunner.
+    """
+
+    def __init__(self, log, size=SOURCE_WORKERS):
+        self.idle = [CommandRunner(log) for _ in range(size)]
+        self.running = {}
+        self.queue = OrderedDict()
+
+    def submit(self, key, command, timeout, callback):
+        if key in self.running or key in self.queue:
+            return False
+        self.queue[key] = (command, timeout, callback)
+        self.dispatch()
+        return True
+
+    def dispatch(self):
+        while self.idle and self.queue:
+            key, (command, timeout, callback) = self.queue.popitem(last=False)
+            runner = self.idle.pop()
+            self.running[key] = runner
+            runner.start(command, timeout,
+                         lambda output, error, key=key, callback=callback:
+                         self.finished(key, callback, output, error))
+
+    def finished(self, key, callback, output, error):
+        runner = self.running.pop(key)
+        self.idle.append(runner)
+        callback(output, error, runner.usage)
+        self.dispatch()
+
+    def cancel(self):
+        """Drop waiting jobs and kill running ones, no callbacks"""
+        self.queue.clear()
+        for runner in self.running.values():
+            runner.cancel()
+            self.idle.append(runner)
+        self.running.clear()
+
+
+class StreamRunner():
+    """Keep a command running and feed each output line as a frame
+
+    The command is started once and restarted with exponential backoff
+    when it exits. Every complete line is passed to on_line, so no graph
+    sample is lost; the redraw of a burst is coalesced by the applet's
+    frame queue.
+    """
+
+    def __init__(self, log, on_line):
+        self.log = log
+        self.on_line = on_line
+        self.command = None
+        self.proc = None
+        self.buffer = b""
+        self.watch_id = None
+        self.restart_id = None
+        self.backoff = STREAM_BACKOFF_MIN
+        self.started_at = 0
+
+    @property
+    def running(self):
+        return self.proc is not None
+
+    def start(self, command):
+        """Start (or restart) streaming the given command"""
+        self.stop()
+        self.command = command
+        self.spawn()
+
+    def spawn(self):
+        self.restart_id = None
+        self.buffer = b""
+        self.log.debug("Starting stream command: %s", self.command)
+        try:
+            self.proc = subprocess.Popen(
+                self.command,
+                shell=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+                start_new_session=True)
+        except Exception as e:
+            self.log.error("Stream command error: %s", e)
+            self.proc = None
+            self.schedule_restart()
+            return False
+        self.started_at = GLib.get_monotonic_time()
+        fd = self.proc.stdout.fileno()
+        os.set_blocking(fd, False)
+        self.watch_id = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.on_readable)
+        return False
+
+    def on_readable(self, fd, condition):
+        """Split incoming data into lines and deliver each of them"""
+        lines = []
+        eof = False
+        while True:
+            try:
+                chunk = os.read(fd, READ_CHUNK)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.log.error("Stream read error: %s", e)
+                chunk = b""
+            if not chunk:
+                eof = True
+                break
+            self.buffer += chunk
+            if b"\n" in self.buffer:
+                *complete, self.buffer = self.buffer.split(b"\n")
+                lines.extend(line for line in complete if line.strip())
+            if len(self.buffer) > STREAM_MAX_LINE:
+                self.log.warning("Stream line too long, dropped")
+                self.buffer = b""
+
+        for line in lines:
+            self.on_line(line.decode(errors="replace").strip())
+
+        if eof:
+            self.watch_id = None
+            self.on_exit()
+            return False
+        return True
+
+    def on_exit(self):
+        """Reap the finished process and schedule a restart"""
+        proc = self.proc
+        self.proc = None
+        proc.stdout.close()
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, proc.pid,
+                             lambda pid, status: None)
+        run_time = (GLib.get_monotonic_time() - self.started_at) / 1000000
+        if run_time >= STREAM_STABLE_RUN:
+            self.backoff = STREAM_BACKOFF_MIN
+        self.log(f"Stream command exited after {run_time:.1f}s", True)
+        self.schedule_restart()
+
+    def schedule_restart(self):
+        self.log.debug("Restarting stream command in %ss", self.backoff)
+        self.restart_id = GLib.timeout_add_seconds(self.backoff, self.spawn)
+        self.backoff = min(self.backoff * 2, STREAM_BACKOFF_MAX)
+
+    def stop(self):
+        """Stop the stream command and any pending restart"""
+        for source_id in (self.watch_id, self.restart_id):
+            if source_id:
+                GLib.source_remove(source_id)
+        self.watch_id = None
+        self.restart_id = None
+        self.backoff = STREAM_BACKOFF_MIN
+        if self.proc is None:
+            return
+        proc = self.proc
+        self.proc = None
+        kill_group(proc)
+        try:
+            proc.stdout.close()
+        except Exception:
+            pass
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, proc.pid,
+                             lambda pid, status: None)
+
+
+class PollScheduler():
+    """Run a callback every interval, slower while nothing changes
+
+    After SCHED_BACKOFF_AFTER identical samples the delay doubles, up to
+    SCHED_BACKOFF_MAX times the interval, and a changed sample snaps it
+    back. No timer runs while a pause reason is set (those in
+    SCHED_ADAPTIVE_PAUSES only count with adaptive on); when the last
+    one is cleared an overdue run happens at once. Whole-second intervals
+    use timeout_add_seconds, so GLib coalesces the wakeups of all
+    applets in the session; shorter ones use millisecond timers.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.interval = 0
+        self.adaptive = True
+        self.factor = 1
+        self.repeats = 0
+        self.paused = set()
+        self.timer_id = None
+        self.due = None
+        self.last_run = None
+        self.penalty = 1
+
+    @staticmethod
+    def now():
+        return GLib.get_monotonic_time() / 1000000
+
+    @property
+    def delay(self):
+        """Seconds between runs with the current backoff"""
+        delay = min(self.interval * self.factor,
+                    max(self.interval, SCHED_BACKOFF_LIMIT))
+        if self.penalty > 1:
+            delay = max(delay, min(self.interval * self.penalty,
+                                   max(self.interval, BREAKER_LIMIT)))
+        return delay
+
+    def start(self, interval, adaptive=True):
+        """Run now, then every interval seconds"""
+        self.stop()
+        self.interval = max(SCHED_MIN_INTERVAL, interval)
+        self.adaptive = adaptive
+        self.due = self.now()
+        self.arm()
+
+    def stop(self):
+        self.cancel_timer()
+        self.due = None
+        self.factor = 1
+        self.repeats = 0
+
+    def cancel_timer(self):
+        if self.timer_id:
+            GLib.source_remove(self.timer_id)
+            self.timer_id = None
+
+    def arm(self):
+        """Install the timer for the next due run, unless paused"""
+        self.cancel_timer()
+        if self.due is None or self.blocked:
+            return
+        delay = self.due - self.now()
+        if delay <= 0:
+            self.timer_id = GLib.idle_add(self.on_timeout)
+        elif self.interval >= 1 and self.interval.is_integer():
+            self.timer_id = GLib.timeout_add_seconds(math.ceil(delay),
+                                                     self.on_timeout)
+        else:
+            self.timer_id = GLib.timeout_add(max(1, round(delay * 1000)),
+                                             self.on_timeout)
+
+    def on_timeout(self):
+        self.timer_id = None
+        self.last_run = self.now()
+        self.due = self.last_run + self.delay
+        try:
+            self.callback()
+        finally:
+            # An error in one run must not stop the polling
+            self.arm()
+        return False
+
+    def report(self, changed):
+        """Feed back whether the last sample differed from the one before"""
+        if not self.adaptive:
+            return
+        if changed:
+            self.repeats = 0
+            if self.factor > 1:
+                self.factor = 1
+                if self.due is not None:
+                    self.due = min(self.due, self.now() + self.interval)
+                    self.arm()
+            return
+        self.repeats += 1
+        if self.repeats >= SCHED_BACKOFF_AFTER:
+            self.repeats = 0
+            self.factor = min(self.factor * 2, SCHED_BACKOFF_MAX)
+
+    def set_penalty(self, factor):
+        """Stretch the delay by factor while runs keep failing"""
+        if factor == self.penalty:
+            return
+        self.penalty = factor
+        if self.due is not None and self.last_run is not None:
+            self.due = self.last_run + self.delay
+            self.arm()
+
+    @property
+    def blocked(self):
+        """Pause reasons in effect"""
+        if self.adaptive:
+            return bool(self.paused)
+        return bool(self.paused - SCHED_ADAPTIVE_PAUSES)
+
+    def pause(self, reason):
+        self.paused.add(reason)
+        self.arm()
+
+    def resume(self, reason):
+        self.paused.discard(reason)
+        self.arm()
+
+
+def run_failure(error, status):
+    """What makes a run count against the circuit breaker, or None
+
+    Negative statuses are signals from Popen, above 128 is how a shell
+    reports a child killed by a signal.
+    """
+    if error:
+        return error
+    if status is not None and (status < 0 or status > 128):
+        signum = -status if status < 0 else status - 128
+        return f"killed by signal {signum}"
+    return None
+
+
+class CircuitBreaker():
+    """Count failed runs in a row and widen the retry interval
+
+    After BREAKER_THRESHOLD failures (timeouts, spawn errors, commands
+    killed by a signal) the breaker opens and factor doubles with every
+    further failure, up to BREAKER_MAX_FACTOR. One good run closes it.
+    A plain non-zero exit is a result, not a failure: grep without a
+    match exits 1.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.factor = 1
+        self.last_error = None
+
+    @property
+    def open(self):
+        return self.failures >= BREAKER_THRESHOLD
+
+    def record(self, error):
+        """Feed the result of a run, True when the breaker changed state"""
+        was_open = self.open
+        if error is None:
+            self.failures = 0
+            self.factor = 1
+            self.last_error = None
+        else:
+            self.failures += 1
+            self.last_error = error
+            if self.open:
+                self.factor = min(
+                    2 ** (self.failures - BREAKER_THRESHOLD + 1),
+                    BREAKER_MAX_FACTOR)
+        return was_open != self.open
+
+    def describe(self):
+        return (f"Failing: {self.failures} runs in a row "
+                f"({self.last_error}), retrying {self.factor}x slower")
+
+
+class CpuBudget():
+    """Rolling CPU cost of a polled command and the slowdown it needs
+
+    Keeps the CPU time (user + system, waited-for children included) of
+    the last BUDGET_RUNS runs. With a budget of `percent` of one core a
+    run costing c seconds may start at most every c / percent * 100
+    seconds; factor is how much the interval is stretched for that.
+    """
+
+    def __init__(self):
+        self.cpu = deque(maxlen=BUDGET_RUNS)
+        self.total = 0.0
+        self.rss = 0
+        self.factor = 1
+
+    def add(self, usage):
+        cpu, rss = usage
+        self.cpu.append(cpu)
+        self.total += cpu
+        self.rss = rss
+
+    @property
+    def mean(self):
+        return sum(self.cpu) / len(self.cpu) if self.cpu else 0.0
+
+    @property
+    def throttled(self):
+        return self.factor > 1
+
+    def update(self, interval, percent):
+        """Recompute factor, True when the throttling state changed"""
+        was_throttled = self.throttled
+        self.factor = 1
+        if percent > 0 and self.cpu:
+            needed = self.mean * 100 / percent
+            self.factor = max(1, round(needed / interval, 1))
+        return was_throttled != self.throttled
+
+    def describe(self, interval):
+        share = self.mean * 100 / (interval * self.factor)
+        text = f"CPU {self.mean * 1000:.1f}ms/run ({share:.2f}% of a core)"
+        if self.rss:
+            text += f", RSS {self.rss / 1024:.1f} MiB"
+        if self.throttled:
+            text += f", slowed {self.factor:g}x by the CPU budget"
+        return text
+
+
+def logind_session_path():
+    """Object path of our logind session, None outside of one"""
+    session = os.environ.get("XDG_SESSION_ID")
+    if not session:
+        return None
+    # sd-bus label escaping
+    escaped = "".join(
+        c if c.isascii() and c.isalnum() and not (i == 0 and c.isdigit())
+        else f"_{ord(c):02x}"
+        for i, c in enumerate(session))
+    return f"/org/freedesktop/login1/session/{escaped}"
+
+
+class SessionWatcher():
+    """Report screen lock, session idle and suspend from D-Bus signals
+
+    on_change(reason, active) is called with reason "locked" (logind's
+    LockedHint of our session), "screensaver", "idle" or "sleep". A
+    missing bus or service only means that reason never fires.
+    """
+
+    def __init__(self, on_change, log):
+        self.on_change = on_change
+        self.log = log
+        self.subscriptions = []
+
+    def start(self):
+        session = Gio.BusType.SESSION
+        system = Gio.BusType.SYSTEM
+        for iface in ("org.mate.ScreenSaver", "org.freedesktop.ScreenSaver",
+                      "org.cinnamon.ScreenSaver"):
+            self.subscribe(session, iface, "ActiveChanged", None,
+                           self.on_screensaver)
+        self.subscribe(session, "org.gnome.SessionManager.Presence",
+                       "StatusChanged", None, self.on_presence)
+        self.subscribe(system, "org.freedesktop.login1.Manager",
+                       "PrepareForSleep", None, self.on_sleep)
+        path = logind_session_path()
+        if path:
+            # Lock/Unlock are requests, LockedHint is the lock state
+            bus = self.subscribe(system, "org.freedesktop.DBus.Properties",
+                                 "PropertiesChanged", path,
+                                 self.on_session_properties)
+            if bus:
+                bus.call("org.freedesktop.login1", path,
+                         "org.freedesktop.DBus.Properties", "Get",
+                         GLib.Variant("(ss)", (LOGIND_SESSION,
+                                               "LockedHint")),
+                         GLib.VariantType("(v)"),
+                         Gio.DBusCallFlags.NONE, -1, None,
+                         self.on_locked_hint)
+
+    def subscribe(self, bus_type, interface, member, path, handler):
+        """Subscribe to a signal, returns the bus or None without one"""
+        try:
+            bus = Gio.bus_get_sync(bus_type, None)
+        except GLib.Error as e:
+            self.log.debug("D-Bus unavailable, not watching %s: %s",
+                           member, e)
+            return None
+        sub_id = bus.signal_subscribe(None, interface, member, path, None,
+                                      Gio.DBusSignalFlags.NONE, handler)
+        self.subscriptions.append((bus, sub_id))
+        return bus
+
+    def on_locked_hint(self, bus, result):
+        try:
+            locked = bus.call_finish(result).unpack()[0]
+        except GLib.Error as e:
+            self.log.debug("No LockedHint: %s", e)
+            return
+        self.on_change("locked", bool(locked))
+
+    def on_session_properties(self, bus, sender, path, iface, signal,
+                              params):
+        interface, changed, _ = params.unpack()
+        if interface == LOGIND_SESSION and "LockedHint" in changed:
+            self.on_change("locked", bool(changed["LockedHint"]))
+
+    def on_screensaver(self, bus, sender, path, iface, signal, params):
+        self.on_change("screensaver", params.unpack()[0])
+
+    def on_presence(self, bus, sender, path, iface, signal, params):
+        self.on_change("idle", params.unpack()[0] == SESSION_STATUS_IDLE)
+
+    def on_sleep(self, bus, sender, path, iface, signal, params):
+        self.on_change("sleep", params.unpack()[0])
+
+    def stop(self):
+        for bus, sub_id in self.subscriptions:
+            bus.signal_unsubscribe(sub_id)
+        self.subscriptions = []
+
+
+COLOR_MAP = {
+    'r': (1, 0, 0),    # red
+    'g': (0, 1, 0),    # green
+    'b': (0, 0, 1),    # blue
+    'y': (1, 1, 0),    # yellow
+    'k': (0, 0, 0),    # black
+    'w': (1, 1, 1),    # white
+    'c': (0, 1, 1),    # cyan
+    'm': (1, 0, 1),    # magenta
+    'o': (1, 0.7, 0),  # orange
+}
+COLOR_CACHE = {}
+HEX_COLOR_RE = re.compile(r'#(?:[0-9a-fA-F]{6}|[0-9a-fA-F]{3})')
+BAR_RE = re.compile(r'(-?[0-9.]+)-(-?[0-9.]+)=([-+0-9.eE]+)')
+ESCAPED_PIPE_RE = re.compile(r'(?<!\\)\|')
+SERIES_NAME_RE = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def parse_color(color_code):
+    """Parse color code like 'g' or '#FFFFFF' or '#29c' to RGB tuple
+
+    Results are cached, so elements can carry ready to use colors.
+    """
+    color = COLOR_CACHE.get(color_code)
+    if color is not None:
+        return color
+
+    color = (1, 1, 1)  # default white
+    if color_code in COLOR_MAP:
+        color = COLOR_MAP[color_code]
+    elif color_code.startswith('#'):
+        # Parse hex color
+        code = color_code.lstrip('#')
+
+        # Handle 3-character shorthand (#29c -> #2299cc)
+        if len(code) == 3:
+            code = ''.join([c*2 for c in code])
+
+        # Parse 6-character hex
+        if len(code) == 6:
+            try:
+                color = tuple(
+                    int(code[i:i+2], 16) / 255.0 for i in (0, 2, 4))
+            except ValueError:
+                pass
+
+    if len(COLOR_CACHE) < 1024:
+        COLOR_CACHE[color_code] = color
+    return color
+
+
+class Element(NamedTuple):
+    """One parsed chart element
+
+    kind is CIRCLE, BAR, HBAR, TXT or GR. Colors are already parsed, a
+    text color of None means the configured font color. For GR elements
+    text is the series name ('' for the default series) and lo/hi are
+    None when the command gave no range.
+    """
+    kind: str
+    color: tuple = None
+    bg: tuple = None
+    value: float = 0.0
+    lo: float = None
+    hi: float = None
+    text: str = ''
+
+
+def bar_background(color):
+    """Default bar background: the inverted bar color, mostly transparent"""
+    return (1.0 - color[0], 1.0 - color[1], 1.0 - color[2], 0.2)
+
+
+def parse_circle(kind, body):
+    return Element('CIRCLE', parse_color(body.split(':', 1)[0]))
+
+
+def parse_bar(kind, body):
+    # BAR:0-100=50[:color[:background]]
+    range_part, *colors = body.split(':')
+    match = BAR_RE.fullmatch(range_part)
+    if not match:
+        raise ValueError("bad range")
+    lo, hi, value = match.groups()
+    color = parse_color(colors[0] if colors else 'g')
+    if len(colors) > 1:
+        bg = parse_color(colors[1]) + (1.0,)
+    else:
+        bg = bar_background(color)
+    return Element(kind, color, bg, float(value), float(lo), float(hi))
+
+
+def parse_text(kind, body):
+    return Element('TXT', None, text=body.replace('\\|', '|'))
+
+
+def parse_colored_text(kind, body):
+    # TXTC:color:text or TXTC:color text, the text may contain ':'
+    match = HEX_COLOR_RE.match(body)
+    end = match.end() if match else 1
+    color, text = body[:end], body[end:]
+    if text[:1] in (':', ' '):
+        text = text[1:]
+    return Element('TXT', parse_color(color), text=text.replace('\\|', '|'))
+
+
+def parse_graph(kind, body):
+    # GR:color:value[:min:max] or GR.name:color:value[:min:max]
+    name = kind[3:]
+    if name and not SERIES_NAME_RE.fullmatch(name):
+        raise ValueError("bad series name")
+    values = body.split(':')
+    if len(values) >= 4:
+        return Element('GR', parse_color(values[0]), value=float(values[1]),
+                       lo=float(values[2]), hi=float(values[3]), text=name)
+    return Element('GR', parse_color(values[0]), value=float(values[1]),
+                   text=name)
+
+
+TOKEN_PARSERS = {
+    'CR': parse_circle,
+    'BAR': parse_bar,
+    'HBAR': parse_bar,
+    'TXT': parse_text,
+    'TXTC': parse_colored_text,
+    'GR': parse_graph,
+}
+TOKEN_CACHE = {}
+TOKEN_CACHE_SIZE = 4096
+BAD_TOKEN = Element('BAD')
+
+
+def parse_token(part):
+    """Parse one token into an Element, None if it is not an element
+
+    Elements are immutable, so tokens seen before (most of them, from
+    frame to frame) are served from a cache.
+    """
+    element = TOKEN_CACHE.get(part)
+    if element is not None or part in TOKEN_CACHE:
+        return element
+    head, colon, body = part.partition(':')
+    parser = TOKEN_PARSERS.get(head) if colon else None
+    if parser is None and colon and head.startswith('GR.'):
+        parser = parse_graph
+    if parser is None:
+        element = None
+    else:
+        try:
+            element = parser(head, body)
+        except Exception:
+            element = BAD_TOKEN
+    if len(TOKEN_CACHE) >= TOKEN_CACHE_SIZE:
+        TOKEN_CACHE.clear()
+    TOKEN_CACHE[part] = element
+    return element
+
+
+def parse_frame(output, log):
+    """Parse command output into lines of Element records
+
+    Lines are separated by '||'. Elements are separated by '|' (text may
+    contain spaces, '\\|' is a literal pipe) or, if the line has no pipe,
+    by whitespace. In the whitespace form words that are not elements
+    continue the previous text. Unknown tokens (like the '2L' marker)
+    are ignored.
+    """
+    lines = []
+    for line in output.split('||'):
+        if '|' in line:
+            if '\\|' in line:
+                parts = ESCAPED_PIPE_RE.split(line)
+            else:
+                parts = line.split('|')
+            words = False
+        else:
+            parts = line.split()
+            words = True
+
+        elements = []
+        for part in parts:
+            element = parse_token(part.strip())
+            if element is None:
+                if words and elements and elements[-1].kind == 'TXT':
+                    # Text with spaces in the whitespace separated form
+                    last = elements[-1]
+                    text = f"{last.text} {part}" if last.text else part
+                    elements[-1] = last._replace(text=text)
+            elif element is BAD_TOKEN:
+                log.warning("Failed to parse %s", part)
+            else:
+                elements.append(element)
+        if elements or not line.strip():
+            lines.append(elements)
+    return lines
+
+
+class FrameError(ValueError):
+    """A JSON frame that does not follow the schema, with its location"""
+
+    def __init__(self, where, problem):
+        super().__init__(f"{where}: {problem}")
+
+
+def json_number(item, key, where, default=None):
+    value = item.get(key, default)
+    if value is None:
+        raise FrameError(f"{where}.{key}", "missing")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise FrameError(f"{where}.{key}", "expected a number")
+    return float(value)
+
+
+def json_color(item, key, where, default=None):
+    """Color as a name/hex string or an [r, g, b] list of 0..1 floats"""
+    value = item.get(key, default)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if value in COLOR_MAP or HEX_COLOR_RE.fullmatch(value):
+            return parse_color(value)
+        raise FrameError(f"{where}.{key}",
+                         f"unknown color {value!r}, expected a color "
+                         f"name or #rgb/#rrggbb")
+    if isinstance(value, list) and len(value) == 3 and \
+            all(isinstance(c, (int, float)) and not isinstance(c, bool)
+                for c in value):
+        return tuple(float(c) for c in value)
+    raise FrameError(f"{where}.{key}", "expected a color")
+
+
+def json_element(item, where):
+    """Element from one entry of a JSON frame line"""
+    if not isinstance(item, dict):
+        raise FrameError(where, "expected an object")
+    kind = item.get("type")
+    if kind == "circle":
+        return Element('CIRCLE', json_color(item, "color", where, 'g'))
+    if kind in ("bar", "hbar"):
+        color = json_color(item, "color", where, 'g')
+        bg = json_color(item, "bg", where)
+        return Element(kind.upper(), color,
+                       bg + (1.0,) if bg else bar_background(color),
+                       json_number(item, "value", where),
+                       json_number(item, "min", where, 0),
+                       json_number(item, "max", where, 100))
+    if kind == "text":
+        text = item.get("text")
+        if not isinstance(text, str):
+            raise FrameError(f"{where}.text", "expected a string")
+        return Element('TXT', json_color(item, "color", where), text=text)
+    raise FrameError(f"{where}.type", f"unknown element type {kind!r}")
+
+
+def json_series(item, where):
+    """GR element from one entry of the series list of a JSON frame"""
+    if not isinstance(item, dict):
+        raise FrameError(where, "expected an object")
+    name = item.get("name", "")
+    if not isinstance(name, str) or \
+            (name and not SERIES_NAME_RE.fullmatch(name)):
+        raise FrameError(f"{where}.name", "expected [A-Za-z0-9_-]+")
+    lo = hi = None
+    if "min" in item or "max" in item:
+        lo = json_number(item, "min", where)
+        hi = json_number(item, "max", where)
+    return Element('GR', json_color(item, "color", where, 'g'),
+                   value=json_number(item, "value", where),
+                   lo=lo, hi=hi, text=name)
+
+
+def parse_json_frame(output, log):
+    """Parse a JSON frame into lines of Element records
+
+    {"lines": [[{"type": "text", "text": "..."}, ...], ...],
+     "series": [{"name": "cpu", "value": 35, "min": 0, "max": 100}]}
+
+    The whole frame is decoded with one json.loads. Of several frames
+    (JSON lines) the last one is used. Invalid elements are logged with
+    their location and skipped, an invalid frame gives no lines.
+    """
+    try:
+        frame = json.loads(output)
+    except json.JSONDecodeError as e:
+        if e.msg != "Extra data":
+            log.warning("Invalid JSON frame: %s", e)
+            return []
+        try:
+            frame = json.loads(output.rstrip().rsplit("\n", 1)[-1])
+        except ValueError as e:
+            log.warning("Invalid JSON frame: %s", e)
+            return []
+    return json_frame_lines(frame, log)
+
+
+def json_frame_lines(frame, log):
+    """Lines of Element records from a decoded JSON frame"""
+    try:
+        if not isinstance(frame, dict):
+            raise FrameError("frame", "expected an object")
+        raw_lines = frame.get("lines", [])
+        raw_series = frame.get("series", [])
+        if not isinstance(raw_lines, list) or \
+                not all(isinstance(line, list) for line in raw_lines):
+            raise FrameError("lines", "expected a list of lists")
+        if not isinstance(raw_series, list):
+            raise FrameError("series", "expected a list")
+    except ValueError as e:
+        log.warning("Invalid JSON frame: %s", e)
+        return []
+
+    lines = []
+    for row, raw_line in enumerate(raw_lines):
+        elements = []
+        for col, item in enumerate(raw_line):
+            try:
+                elements.append(json_element(item, f"lines[{row}][{col}]"))
+            except FrameError as e:
+                log.warning("Invalid JSON frame: %s", e)
+        lines.append(elements)
+    graph = []
+    for idx, item in enumerate(raw_series):
+        try:
+            graph.append(json_series(item, f"series[{idx}]"))
+        except FrameError as e:
+            log.warning("Invalid JSON frame: %s", e)
+    if graph:
+        # A line of GR elements only takes no room on the chart
+        lines.append(graph)
+    return lines
+
+
+def split_frame(lines):
+    """Split parsed lines into drawable lines and GR elements"""
+    drawable = []
+    graph = []
+    for elements in lines:
+        items = []
+        for element in elements:
+            if element.kind == 'GR':
+                graph.append(element)
+            else:
+                items.append(element)
+        # Lines holding only GR values take no room on the chart
+        if items or not elements:
+            drawable.append(items)
+    return drawable, graph
+
+
+def color_code(color):
+    """Text syntax code of an RGB color, a letter where there is one"""
+    for code, value in COLOR_MAP.items():
+        if value == tuple(color[:3]):
+            return code
+    return "#" + "".join(f"{round(c * 255):02x}" for c in color[:3])
+
+
+def number_text(value, exponent=True):
+    """Shortest text that parses back to value
+
+    BAR ranges take no exponent, exponent=False writes it out.
+    """
+    text = repr(float(value))
+    if not exponent and "e" in text:
+        text = f"{value:f}"
+    return text[:-2] if text.endswith(".0") else text
+
+
+def frame_text(lines):
+    """Parsed lines back in the text syntax, parse_frame reads it again"""
+    texts = []
+    for elements in lines:
+        items = []
+        for element in elements:
+            kind = element.kind
+            if kind == 'CIRCLE':
+                items.append(f"CR:{color_code(element.color)}")
+            elif kind in ('BAR', 'HBAR'):
+                item = (f"{kind}:{number_text(element.lo, False)}-"
+                        f"{number_text(element.hi, False)}="
+                        f"{number_text(element.value)}:"
+                        f"{color_code(element.color)}")
+                if element.bg != bar_background(element.color):
+                    item += f":{color_code(element.bg)}"
+                items.append(item)
+            elif kind == 'GR':
+                name = f".{element.text}" if element.text else ""
+                item = (f"GR{name}:{color_code(element.color)}:"
+                        f"{number_text(element.value)}")
+                if element.lo is not None:
+                    item += (f":{number_text(element.lo)}:"
+                             f"{number_text(element.hi)}")
+                items.append(item)
+            else:
+                text = element.text.replace('|', '\\|')
+                if element.color is None:
+                    items.append(f"TXT:{text}")
+                else:
+                    items.append(f"TXTC:{color_code(element.color)}:{text}")
+        texts.append(" | ".join(items))
+    return " || ".join(texts)
+
+
+def format_age(seconds):
+    """Short age like 45s, 12m or 3h"""
+    if seconds < 120:
+        return f"{seconds:.0f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.0f}h"
+
+
+def frame_path(config_path):
+    """Last output of an instance, shown at once on the next start"""
+    return os.path.join(os.path.expanduser(HISTORY_DIR),
+                        f"frame-{instance_name(config_path)}.txt")
+
+
+def sampler_socket_path():
+    """Unix socket of the shared sampler, see cmd-chart-sampler.py"""
+    return os.path.join(GLib.get_user_runtime_dir(), "cmd-chart-applet",
+                        "sampler.sock")
+
+
+def stats_path(config_path):
+    """Live metrics of an instance, see CycleStats"""
+    return os.path.join(GLib.get_user_runtime_dir(), "cmd-chart-applet",
+                        f"stats-{instance_name(config_path)}.json")
+
+
+def push_path(config_path):
+    """Socket an instance in push mode listens on"""
+    return os.path.join(GLib.get_user_runtime_dir(), "cmd-chart-applet",
+                        f"push-{instance_name(config_path)}.sock")
+
+
+class SamplerClient():
+    """Subscription to a command on the shared sampler
+
+    Messages (decoded JSON objects) are passed to on_message, on_close is
+    called when the sampler goes away.
+    """
+
+    def __init__(self, log, on_message, on_close):
+        self.log = log
+        self.on_message = on_message
+        self.on_close = on_close
+        self.sock = None
+        self.buffer = b""
+        self.watch_id = None
+
+    def connect(self, command, interval, timeout):
+        """Connect and subscribe, return False if the sampler is not up"""
+        import socket  # only needed with the shared sampler
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sampler_socket_path())
+            request = {"command": command, "interval": interval,
+                       "timeout": timeout}
+            sock.sendall(json.dumps(request).encode() + b"\n")
+        except OSError:
+            sock.close()
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        self.buffer = b""
+        self.watch_id = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.on_readable)
+        return True
+
+    def on_readable(self, fd, condition):
+        while True:
+            try:
+                chunk = self.sock.recv(READ_CHUNK)
+            except BlockingIOError:
+                break
+            except OSError:
+                chunk = b""
+            if not chunk:
+                self.watch_id = None
+                self.close()
+                self.on_close()
+                return False
+            self.buffer += chunk
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            try:
+                self.on_message(json.loads(line))
+            except ValueError as e:
+                self.log.error("Bad sampler message: %s", e)
+        return True
+
+    def close(self):
+        if self.watch_id:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class PushServer():
+    """Accept frames pushed by other processes over a Unix socket
+
+    Every newline-terminated line a client writes is a frame; of the
+    lines that arrive in one read only the newest is used. Frames are
+    admitted by a token bucket of PUSH_RATE per second (PUSH_BURST at
+    once). While it is empty only the newest frame is kept and delivered
+    as soon as a token is available, so a chatty pusher costs at most
+    PUSH_RATE parses per second.
+    """
+
+    def __init__(self, log, on_frame):
+        self.log = log
+        self.on_frame = on_frame
+        self.sock = None
+        self.path = None
+        self.accept_id = None
+        self.clients = {}
+        self.tokens = PUSH_BURST
+        self.refilled = 0
+        self.pending = None
+        self.release_id = None
+
+    def start(self, path):
+        """Listen on path, return False if that failed"""
+        import socket
+        self.stop()
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            os.chmod(path, 0o600)
+            sock.listen(PUSH_MAX_CLIENTS)
+        except OSError as e:
+            self.log.error("Cannot listen on %s: %s", path, e)
+            return False
+        sock.setblocking(False)
+        self.sock = sock
+        self.path = path
+        self.accept_id = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.on_accept)
+        return True
+
+    def on_accept(self, fd, condition):
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return True
+        if len(self.clients) >= PUSH_MAX_CLIENTS:
+            self.log.warning("Too many push clients, connection refused")
+            conn.close()
+            return True
+        conn.setblocking(False)
+        watch_id = GLib.io_add_watch(
+            conn.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.on_client_readable)
+        self.clients[conn.fileno()] = [conn, b"", watch_id]
+        return True
+
+    def on_client_readable(self, fd, condition):
+        client = self.clients.get(fd)
+        if client is None:
+            return False
+        conn = client[0]
+        last_line = None
+        eof = False
+        while True:
+            try:
+                chunk = conn.recv(READ_CHUNK)
+            except BlockingIOError:
+                break
+            except OSError:
+                chunk = b""
+            if not chunk:
+                eof = True
+                break
+            client[1] += chunk
+            if b"\n" in client[1]:
+                *lines, client[1] = client[1].split(b"\n")
+                for line in reversed(lines):
+                    if line.strip():
+                        last_line = line
+                        break
+            if len(client[1]) > STREAM_MAX_LINE:
+                self.log.warning("Pushed frame too long, dropped")
+                client[1] = b""
+
+        if last_line is not None:
+            self.push(last_line.decode(errors="replace").strip())
+        if eof:
+            client[2] = None
+            self.drop_client(fd)
+            return False
+        return True
+
+    def drop_client(self, fd):
+        conn, _, watch_id = self.clients.pop(fd)
+        if watch_id:
+            GLib.source_remove(watch_id)
+        conn.close()
+
+    def push(self, frame):
+        """Deliver the frame now or, over the rate, when a token is due"""
+        now = GLib.get_monotonic_time() / 1000000
+        self.tokens = min(PUSH_BURST,
+                          self.tokens + (now - self.refilled) * PUSH_RATE)
+        self.refilled = now
+        if self.tokens >= 1 and self.release_id is None:
+            self.tokens -= 1
+            self.on_frame(frame)
+            return
+        self.pending = frame
+        if self.release_id is None:
+            wait = (1 - self.tokens) / PUSH_RATE
+            self.release_id = GLib.timeout_add(
+                max(1, math.ceil(wait * 1000)), self.release)
+
+    def release(self):
+        self.release_id = None
+        frame, self.pending = self.pending, None
+        if frame is not None:
+            self.push(frame)
+        return False
+
+    def stop(self):
+        for fd in list(self.clients):
+            self.drop_client(fd)
+        for source_id in (self.accept_id, self.release_id):
+            if source_id:
+                GLib.source_remove(source_id)
+        self.accept_id = None
+        self.release_id = None
+        self.pending = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class ProcFile():
+    """A /proc or /sys file kept open and re-read from offset 0"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    def read(self):
+        chunks = []
+        offset = 0
+        while True:
+            chunk = os.pread(self.fd, READ_CHUNK, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join(chunks).decode(errors="replace")
+
+    def close(self):
+        os.close(self.fd)
+
+
+def level_color(percent, warn=60, crit=80):
+    """Pick green/yellow/red for a value like the example scripts do"""
+    if percent < warn:
+        return 'g'
+    if percent < crit:
+        return 'y'
+    return 'r'
+
+
+def human_rate(value):
+    """Format bytes per second as a short string"""
+    for unit in ("", "K", "M", "G"):
+        if value < 1000:
+            return f"{value:.0f}{unit}"
+        value /= 1024
+    return f"{value:.0f}T"
+
+
+def bar_element(value, lo, hi, color):
+    color = parse_color(color)
+    return Element('BAR', color, bar_background(color), value, lo, hi)
+
+
+def text_element(text, color=None):
+    return Element('TXT', parse_color(color) if color else None, text=text)
+
+
+class Provider():
+    """Base class of the built-in metric providers
+
+    sample() returns the main value of the metric, elements() returns the
+    chart elements for the last sample. lo/hi is the value range used for
+    bars and graphs.
+    """
+    lo = 0
+    hi = 100
+
+    def __init__(self, arg=None):
+        self.arg = arg
+        self.value = 0.0
+
+    def sample(self):
+        raise NotImplementedError
+
+    def elements(self):
+        return [bar_element(self.value, self.lo, self.hi,
+                            level_color(self.value))]
+
+    def close(self):
+        for f in self.__dict__.values():
+            if isinstance(f, ProcFile):
+                f.close()
+
+
+class LoadProvider(Provider):
+    """Load average from /proc/loadavg"""
+    hi = 5
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile("/proc/loadavg")
+
+    def sample(self):
+        self.value = float(self.file.read().split(None, 1)[0])
+        return self.value
+
+    def elements(self):
+        if self.value < 1:
+            color = 'g'
+        elif self.value < 2:
+            color = 'y'
+        else:
+            color = 'r'
+        return [Element('CIRCLE', parse_color(color)),
+                bar_element(self.value, self.lo, self.hi, 'o')]
+
+
+class CpuProvider(Provider):
+    """CPU usage in percent from /proc/stat"""
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile("/proc/stat")
+        self.prev_total = 0
+        self.prev_idle = 0
+
+    def sample(self):
+        fields = self.file.read().split("\n", 1)[0].split()[1:]
+        values = [int(v) for v in fields]
+        # idle + iowait
+        idle = values[3] + (values[4] if len(values) > 4 else 0)
+        total = sum(values[:8])
+        d_total = total - self.prev_total
+        d_idle = idle - self.prev_idle
+        self.prev_total, self.prev_idle = total, idle
+        if d_total > 0:
+            self.value = 100.0 * (d_total - d_idle) / d_total
+        return self.value
+
+    def elements(self):
+        return super().elements() + [text_element(f"C{self.value:.0f}%")]
+
+
+class MemProvider(Provider):
+    """Used memory in percent from /proc/meminfo"""
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile("/proc/meminfo")
+
+    def sample(self):
+        info = {}
+        for line in self.file.read().splitlines():
+            key, _, rest = line.partition(":")
+            if key in ("MemTotal", "MemAvailable"):
+                info[key] = int(rest.split()[0])
+                if len(info) == 2:
+                    break
+        total = info.get("MemTotal", 0)
+        if total:
+            self.value = 100.0 * (total - info.get("MemAvailable", 0)) / total
+        return self.value
+
+    def elements(self):
+        return super().elements() + [text_element(f"M{self.value:.0f}%")]
+
+
+class TempProvider(Provider):
+    """Temperature from /sys/class/hwmon, arg selects the hwmon name"""
+    preferred = ("coretemp", "k10temp", "zenpower", "cpu_thermal",
+                 "acpitz")
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile(self.find_sensor(arg))
+
+    def find_sensor(self, name):
+        base = "/sys/class/hwmon"
+        sensors = {}
+        for hwmon in sorted(os.listdir(base)):
+            try:
+                with open(os.path.join(base, hwmon, "name")) as f:
+                    sensors.setdefault(f.read().strip(), hwmon)
+            except OSError:
+                continue
+        names = (name,) if name else self.preferred + tuple(sensors)
+        for candidate in names:
+            if candidate in sensors:
+                path = os.path.join(base, sensors[candidate], "temp1_input")
+                if os.path.exists(path):
+                    return path
+        raise ValueError(f"No temperature sensor {name or ''}")
+
+    def sample(self):
+        self.value = int(self.file.read()) / 1000.0
+        return self.value
+
+    def elements(self):
+        return [text_element(f"{self.value:.0f}°C")] + super().elements()
+
+
+class CounterProvider(Provider):
+    """Base for byte counters, the value is the total rate in bytes/s"""
+    hi = 100 * 1024 * 1024
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.prev = None
+        self.prev_time = 0
+        self.rates = (0.0, 0.0)
+
+    def counters(self):
+        raise NotImplementedError
+
+    def sample(self):
+        now = GLib.get_monotonic_time()
+        counters = self.counters()
+        if self.prev is not None and now > self.prev_time:
+            dt = (now - self.prev_time) / 1000000
+            self.rates = tuple(max(0, c - p) / dt
+                               for c, p in zip(counters, self.prev))
+        self.prev = counters
+        self.prev_time = now
+        self.value = sum(self.rates)
+        return self.value
+
+
+class NetProvider(CounterProvider):
+    """Network throughput from /proc/net/dev, arg selects the interface"""
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile("/proc/net/dev")
+
+    def counters(self):
+        rx = tx = 0
+        for line in self.file.read().splitlines()[2:]:
+            iface, _, data = line.partition(":")
+            iface = iface.strip()
+            if (self.arg and iface != self.arg) or \
+                    (not self.arg and iface == "lo"):
+                continue
+            fields = data.split()
+            rx += int(fields[0])
+            tx += int(fields[8])
+        return (rx, tx)
+
+    def elements(self):
+        rx, tx = self.rates
+        return [text_element(f"↓{human_rate(rx)} ↑{human_rate(tx)}")]
+
+
+class DiskProvider(CounterProvider):
+    """Disk throughput from /proc/diskstats, arg selects the device"""
+
+    def __init__(self, arg=None):
+        super().__init__(arg)
+        self.file = ProcFile("/proc/diskstats")
+        # Whole disks only, partitions would be counted twice
+        self.devices = {arg} if arg else {
+            d for d in os.listdir("/sys/block")
+            if not d.startswith(("loop", "ram", "zram", "dm-"))}
+
+    def counters(self):
+        read = written = 0
+        for line in self.file.read().splitlines():
+            fields = line.split()
+            if len(fields) > 9 and fields[2] in self.devices:
+                read += int(fields[5]) * 512
+                written += int(fields[9]) * 512
+        return (read, written)
+
+    def elements(self):
+        r, w = self.rates
+        return [text_element(f"R{human_rate(r)} W{human_rate(w)}")]
+
+
+PROVIDERS = {
+    "load": LoadProvider,
+    "cpu": CpuProvider,
+    "mem": MemProvider,
+    "temp": TempProvider,
+    "net": NetProvider,
+    "disk": DiskProvider,
+}
+
+
+def provider_series_name(provider):
+    """Graph series name of a provider, like 'cpu' or 'net-eth0'"""
+    name = type(provider).__name__[:-len("Provider")].lower()
+    if provider.arg:
+        name += "-" + provider.arg
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+
+
+class BuiltinSampler():
+    """Produce chart elements from built-in providers instead of a command
+
+    The command looks like 'builtin:load cpu mem || net/eth0 gr:cpu:r'.
+    '||' separates lines, 'name/arg' passes an argument to a provider and
+    'gr:name[:color]' feeds the provider value to the background graph.
+    Providers are created once and keep their files open between samples.
+    """
+
+    def __init__(self, spec, log):
+        self.log = log
+        self.providers = {}
+        self.layout = []
+        for line in spec[len(BUILTIN_PREFIX):].split("||"):
+            items = []
+            for token in line.replace(",", " ").split():
+                graph_color = None
+                if token.startswith("gr:"):
+                    _, token, *color = token.split(":")
+                    graph_color = color[0] if color else 'g'
+                provider = self.get_provider(token)
+                if provider:
+                    items.append((provider, graph_color))
+            self.layout.append(items)
+
+    def get_provider(self, token):
+        if token not in self.providers:
+            name, _, arg = token.partition("/")
+            try:
+                self.providers[token] = PROVIDERS[name](arg or None)
+            except KeyError:
+                self.log.error("Unknown builtin provider: %s", name)
+                self.providers[token] = None
+            except Exception as e:
+                self.log.error("Failed to init provider %s: %s", token, e)
+                self.providers[token] = None
+        return self.providers[token]
+
+    def sample(self):
+        """Sample every provider once, return lines of elements"""
+        for provider in self.providers.values():
+            if provider:
+                provider.sample()
+        lines = []
+        for items in self.layout:
+            elements = []
+            for provider, graph_color in items:
+                if graph_color:
+                    elements.append(Element(
+                        'GR', parse_color(graph_color), value=provider.value,
+                        lo=provider.lo, hi=provider.hi,
+                        text=provider_series_name(provider)))
+                else:
+                    elements.extend(provider.elements())
+            lines.append(elements)
+        return lines
+
+    def close(self):
+        for provider in self.providers.values():
+            if provider:
+                provider.close()
+
+
+class SourceSpec(NamedTuple):
+    line: int
+    interval: float
+    timeout: int
+    command: str
+
+
+def parse_source(spec):
+    """Parse 'line:interval-ms:timeout-s:command' from the sources key"""
+    line, interval, timeout, command = spec.split(":", 3)
+    source = SourceSpec(int(line), int(interval) / 1000, int(timeout),
+                        command.strip())
+    if source.line < 1 or not source.command:
+        raise ValueError("line must be 1 or more and command not empty")
+    if source.command.startswith(PLUGIN_PREFIX):
+        plugin_spec(source.command)
+    return source
+
+
+class Source():
+    """An extra command or provider polled on its own interval
+
+    Its drawable lines are placed from spec.line (1-based) on, after the
+    elements already on that line.
+    """
+
+    def __init__(self, key, spec):
+        self.key = key
+        self.spec = spec
+        self.lines = []
+        self.graph = []
+        self.last_output = None
+        self.builtin = None
+        self.plugin = None
+        self.scheduler = None
+        self.budget = CpuBudget()
+        self.error = None
+
+    def close(self):
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.plugin:
+            self.plugin.cancel()
+        if self.builtin:
+            self.builtin.close()
+            self.builtin = None
+
+
+class Style(NamedTuple):
+    """Snapshot of the appearance settings used while drawing"""
+    font_family: str
+    font_size: int
+    font_color: tuple
+    shadow: bool
+    shadow_color: tuple
+    bar_width: int
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get_string("font-family") or "Sans",
+                   settings.get_int("font-size") or 12,
+                   parse_color(settings.get_string("font-color")),
+                   settings.get_boolean("enable-font-shadow"),
+                   parse_color(settings.get_string("font-shadow-color")),
+                   settings.get_int("bar-width"))
+
+
+class TextLayoutCache():
+    """LRU cache of shaped Pango layouts keyed on text and font
+
+    A cached layout is drawn without shaping again, which matters for
+    emoji and complex text. Entries are (layout, width, baseline) in
+    pixels.
+    """
+
+    def __init__(self, widget, size=TEXT_CACHE_SIZE):
+        self.widget = widget
+        self.size = size
+        self.entries = OrderedDict()
+        self.font = None
+        self.font_desc = None
+
+    def set_font(self, family, size):
+        """Select the font, the pixel size matches cairo set_font_size"""
+        font = (family, size)
+        if font != self.font:
+            self.font = font
+            self.font_desc = Pango.FontDescription.from_string(family)
+            self.font_desc.set_absolute_size(size * Pango.SCALE)
+
+    def get(self, text):
+        key = (text, self.font)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        layout = Pango.Layout.new(self.widget.get_pango_context())
+        layout.set_font_description(self.font_desc)
+        layout.set_text(text, -1)
+        _, logical = layout.get_pixel_extents()
+        entry = (layout, logical.width, layout.get_baseline() / Pango.SCALE)
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted, non-empty sequence"""
+    return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+
+class CycleStats():
+    """Rolling per-cycle metrics of one applet
+
+    Every metric keeps its last STATS_SAMPLES values in a deque, times
+    are in milliseconds. summary() reports last/p50/p95/max of each.
+    """
+
+    def __init__(self, size=STATS_SAMPLES):
+        self.size = size
+        self.metrics = OrderedDict()
+        self.status = None
+        self.cycles = 0
+
+    def add(self, metric, value):
+        values = self.metrics.get(metric)
+        if values is None:
+            values = self.metrics[metric] = deque(maxlen=self.size)
+        values.append(value)
+
+    def summary(self):
+        result = {}
+        for metric, values in self.metrics.items():
+            ordered = sorted(values)
+            result[metric] = {"last": values[-1],
+                              "p50": percentile(ordered, 50),
+                              "p95": percentile(ordered, 95),
+                              "max": ordered[-1]}
+        return result
+
+    def describe(self):
+        """One line for the tooltip: p50/p95 of the timings"""
+        summary = self.summary()
+        parts = [f"{metric} {summary[metric]['p50']:.1f}/"
+                 f"{summary[metric]['p95']:.1f}ms"
+                 for metric in ("command", "parse", "draw")
+                 if metric in summary]
+        if self.status is not None:
+            parts.append(f"exit {self.status}")
+        return "p50/p95: " + ", ".join(parts)
+
+
+class HistoryFile():
+    """Fixed-capacity ring buffer of (timestamp, value) doubles on disk
+
+    The file is memory-mapped: appending writes one record in place,
+    loading reads at most capacity records. Writes reach the page cache
+    at once, msync is coalesced to one per HISTORY_FLUSH_DELAY seconds.
+
+    Layout: header (magic, version, capacity, head, count) followed by
+    capacity records, head is the slot of the next write.
+    """
+
+    MAGIC = HISTORY_MAGIC
+    VERSION = HISTORY_VERSION
+    RECORD = HISTORY_RECORD
+
+    def __init__(self, path, capacity, log, legacy=False):
+        self.path = path
+        self.log = log
+        self.legacy = legacy
+        self.file = None
+        self.map = None
+        self.capacity = 0
+        self.head = 0
+        self.count = 0
+        self.flush_id = None
+        self.open(capacity)
+
+    def open(self, capacity):
+        """Open the file, converting it if the capacity changed"""
+        records = self.read_records()
+        self.close()
+        capacity = max(1, capacity)
+        size = HISTORY_HEADER.size + capacity * self.RECORD.size
+        self.file = open(self.path, "a+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+        for record in records[-capacity:]:
+            self.write_record(*record)
+        self.write_header()
+
+    @classmethod
+    def unpack_records(cls, buf, capacity, head, count):
+        first = (head - count) % capacity
+        return [cls.RECORD.unpack_from(
+                    buf, HISTORY_HEADER.size +
+                    ((first + i) % capacity) * cls.RECORD.size)
+                for i in range(count)]
+
+    def read_records(self):
+        """Records of the current file (or its legacy text), oldest first"""
+        if self.map is None:
+            return self.load()
+        return self.unpack_records(self.map, self.capacity, self.head,
+                                   self.count)
+
+    def load(self):
+        """Read records from disk before the file is mapped"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return self.load_legacy() if self.legacy else []
+        except OSError as e:
+            self.log.error("Error loading history: %s", e)
+            return []
+        try:
+            magic, version, capacity, head, count = \
+                HISTORY_HEADER.unpack_from(data)
+            if magic != self.MAGIC or version != self.VERSION or \
+                    len(data) < HISTORY_HEADER.size + \
+                    capacity * self.RECORD.size or \
+                    head >= capacity or count > capacity:
+                raise ValueError("not a history file")
+            return self.unpack_records(data, capacity, head, count)
+        except (ValueError, struct.error) as e:
+            self.log.error("Error loading history: %s", e)
+            return []
+
+    def load_legacy(self):
+        """Import the tail of the old shared text history, if any"""
+        path = os.path.join(os.path.dirname(self.path), LEGACY_HISTORY)
+        records = []
+        try:
+            with open(path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                start = max(0, f.tell() - LEGACY_TAIL_BYTES)
+                f.seek(start)
+                lines = f.read().split(b"\n")
+                # A read from the middle of the file starts mid-line
+                for line in lines[1:] if start else lines:
+                    try:
+                        value = float(line)
+                    except ValueError:
+                        continue
+                    if not math.isnan(value):
+                        records.append((0.0, value))
+        except OSError:
+            pass
+        return records
+
+    def write_record(self, *fields):
+        self.RECORD.pack_into(
+            self.map,
+            HISTORY_HEADER.size + self.head * self.RECORD.size,
+            *fields)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def write_header(self):
+        HISTORY_HEADER.pack_into(self.map, 0, self.MAGIC,
+                                 self.VERSION, self.capacity,
+                                 self.head, self.count)
+
+    def schedule_flush(self):
+        if not self.flush_id:
+            self.flush_id = GLib.timeout_add_seconds(HISTORY_FLUSH_DELAY,
+                                                     self.flush)
+
+    def append_record(self, *fields):
+        """Store one record, O(1)"""
+        self.write_record(*fields)
+        self.write_header()
+        self.schedule_flush()
+
+    def replace_last(self, *fields):
+        """Overwrite the newest record in place"""
+        if not self.count:
+            self.append_record(*fields)
+            return
+        slot = (self.head - 1) % self.capacity
+        self.RECORD.pack_into(
+            self.map, HISTORY_HEADER.size + slot * self.RECORD.size,
+            *fields)
+        self.schedule_flush()
+
+    def append(self, value, timestamp=None):
+        """Store one value, O(1)"""
+        if timestamp is None:
+            timestamp = time.time()
+        self.append_record(timestamp, value)
+
+    def values(self):
+        """Stored values, oldest first"""
+        return [value for _, value in self.read_records()]
+
+    def flush(self):
+        self.flush_id = None
+        if self.map is not None:
+            self.map.flush()
+        return False
+
+    def close(self):
+        if self.flush_id:
+            GLib.source_remove(self.flush_id)
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class RollupFile(HistoryFile):
+    """Ring of rollup buckets (start, count, min, max, total) on disk"""
+
+    MAGIC = ROLLUP_MAGIC
+    RECORD = ROLLUP_RECORD
+
+
+class Rollup():
+    """Fixed-size buckets of one series, min/avg/max per bucket
+
+    Adding a value updates the newest bucket or starts a new one, both
+    O(1). The newest bucket is rewritten in place in the file, so a
+    restart continues it.
+    """
+
+    def __init__(self, step, capacity):
+        self.step = step
+        self.buckets = deque(maxlen=capacity)
+        self.file = None
+
+    def load(self, records):
+        self.buckets.clear()
+        self.buckets.extend(list(record) for record in records)
+
+    def add(self, value, timestamp):
+        start = timestamp - timestamp % self.step
+        last = self.buckets[-1] if self.buckets else None
+        if last is not None and last[0] == start:
+            last[1] += 1
+            last[2] = min(last[2], value)
+            last[3] = max(last[3], value)
+            last[4] += value
+            if self.file:
+                self.file.replace_last(*last)
+        else:
+            bucket = [start, 1, value, value, value]
+            self.buckets.append(bucket)
+            if self.file:
+                self.file.append_record(*bucket)
+
+    def columns(self, now):
+        """(avg, min, max) arrays of the span ending at now
+
+        One slot per bucket of the span, placed by the bucket start time.
+        Slots without data (the applet was off or paused) are NaN and
+        buckets older than the span are left out.
+        """
+        capacity = self.buckets.maxlen
+        first = now - now % self.step - (capacity - 1) * self.step
+        avg = array('d', [math.nan]) * capacity
+        lows = array('d', avg)
+        highs = array('d', avg)
+        for start, count, low, high, total in self.buckets:
+            slot = round((start - first) / self.step)
+            if 0 <= slot < capacity:
+                avg[slot] = total / count
+                lows[slot] = low
+                highs[slot] = high
+        return avg, lows, highs
+
+    def span_len(self, now):
+        """Buckets within the span ending at now"""
+        oldest = now - now % self.step - (self.buckets.maxlen - 1) * self.step
+        return sum(1 for bucket in self.buckets
+                   if oldest <= bucket[0] <= now)
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+def instance_name(config_path):
+    """File name friendly form of the preferences path"""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', config_path.strip('/'))
+
+
+def history_path(config_path):
+    """Per instance history file derived from the preferences path"""
+    return os.path.join(os.path.expanduser(HISTORY_DIR),
+                        f"history-{instance_name(config_path)}.bin")
+
+
+def series_path(config_path, name):
+    """History file of a series, the default series keeps the plain name"""
+    path = history_path(config_path)
+    if name:
+        path = f"{path[:-len('.bin')]}.{name}.bin"
+    return path
+
+
+def rollup_path(config_path, name, tier):
+    """Rollup file of a series, '@' keeps it apart from series names"""
+    return f"{series_path(config_path, name)[:-len('.bin')]}@{tier}.bin"
+
+
+def saved_series(config_path):
+    """Names of the series with a history file for this instance
+
+    Series not updated for SERIES_EXPIRE seconds are deleted with their
+    rollups, of the rest the SERIES_MAX most recently updated are kept.
+    """
+    path = history_path(config_path)
+    prefix = os.path.basename(path)[:-len('.bin')] + '.'
+    found = []
+    try:
+        for filename in os.listdir(os.path.dirname(path)):
+            if filename.startswith(prefix) and filename.endswith('.bin'):
+                name = filename[len(prefix):-len('.bin')]
+                if SERIES_NAME_RE.fullmatch(name):
+                    mtime = os.stat(series_path(config_path, name)).st_mtime
+                    found.append((mtime, name))
+    except OSError:
+        pass
+    names = []
+    expired = time.time() - SERIES_EXPIRE
+    for mtime, name in sorted(found, reverse=True):
+        if mtime >= expired:
+            names.append(name)
+            continue
+        for path in [series_path(config_path, name)] + [
+                rollup_path(config_path, name, tier)
+                for tier in ROLLUP_TIERS]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return sorted(names[:SERIES_MAX])
+
+
+class Series():
+    """One named graph series
+
+    Values live in a fixed-size ring of doubles (array('d')), appending
+    is O(1). color/lo/hi come from the last GR element of the series,
+    seen is set once the series got a value in this session. Longer
+    spans are kept in rollups, one per ROLLUP_TIERS entry. The envelope
+    of the drawn width is updated on append, so drawing the history
+    does not scan it.
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.color = parse_color('g')
+        self.lo = None
+        self.hi = None
+        self.seen = False
+        self.file = None
+        self.envelope = None
+        self.rollups = OrderedDict(
+            (tier, Rollup(step, size))
+            for tier, (step, size) in ROLLUP_TIERS.items())
+        self.resize(capacity)
+
+    def resize(self, capacity, values=None):
+        """Set the capacity keeping the newest values"""
+        if values is None:
+            values = self.ordered() if hasattr(self, 'ring') else []
+        capacity = max(1, capacity)
+        values = values[-capacity:]
+        self.ring = array('d', bytes(8 * capacity))
+        self.ring[:len(values)] = array('d', values)
+        self.count = len(values)
+        self.head = self.count % capacity
+        self.envelope = None
+
+    def append(self, value):
+        self.ring[self.head] = value
+        self.head = (self.head + 1) % len(self.ring)
+        if self.count < len(self.ring):
+            self.count += 1
+        if self.envelope:
+            self.envelope.add(value, self.count)
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.envelope = None
+
+    def reduced(self, columns):
+        """(points, min, max) of the history reduced to columns
+
+        Points are (position, value) like reduce_envelope gives them.
+        """
+        if len(self) <= 2 * columns:
+            values = self.ordered()
+            return list(enumerate(values)), min(values), max(values)
+        if self.envelope is None or self.envelope.columns != columns:
+            self.envelope = Envelope(self.ordered(), columns)
+        return self.envelope.points(self)
+
+    def value_range(self, start, end):
+        """Values at positions start..end-1, position 0 is the oldest"""
+        first = self.head - self.count
+        size = len(self.ring)
+        return [self.ring[(first + pos) % size] for pos in range(start, end)]
+
+    def add_rollups(self, value, timestamp):
+        for rollup in self.rollups.values():
+            rollup.add(value, timestamp)
+
+    def columns(self, span, now):
+        """(values, band low, band high) for a graph span, band may be None
+
+        Rollup spans are laid out in time up to now, NaN marks a gap.
+        """
+        rollup = self.rollups.get(span)
+        if rollup is None:
+            return self.ordered(), None, None
+        return rollup.columns(now)
+
+    def span_len(self, span, now):
+        rollup = self.rollups.get(span)
+        return len(self) if rollup is None else rollup.span_len(now)
+
+    def close(self):
+        for storage in [self.file] + [r.file for r in self.rollups.values()]:
+            if storage:
+                storage.close()
+
+    def ordered(self):
+        """Values oldest first, as an array"""
+        if self.count < len(self.ring):
+            return self.ring[:self.count]
+        return self.ring[self.head:] + self.ring[:self.head]
+
+    def __len__(self):
+        return self.count
+
+
+def reduce_envelope(values, buckets, gaps=False):
+    """Reduce values to about 2 points per bucket keeping the envelope
+
+    Each bucket keeps its minimum and maximum in the order they occurred,
+    so spikes survive however long the history is. Returns a list of
+    (position, value) with positions in the original index space. With
+    gaps, NaN values are skipped and a bucket of NaN only gives one NaN
+    point, which splits the line when drawn.
+    """
+    count = len(values)
+    if count <= 2 * buckets:
+        return list(enumerate(values))
+    points = []
+    size = count / buckets
+    for bucket in range(buckets):
+        start = int(bucket * size)
+        end = int((bucket + 1) * size)
+        chunk = values[start:end]
+        present = [v for v in chunk if v == v] if gaps else chunk
+        if not present:
+            points.append((start, math.nan))
+            continue
+        lo = min(present)
+        hi = max(present)
+        i_lo = chunk.index(lo)
+        i_hi = chunk.index(hi)
+        if i_lo == i_hi:
+            points.append((start + i_lo, lo))
+        elif i_lo < i_hi:
+            points.append((start + i_lo, lo))
+            points.append((start + i_hi, hi))
+        else:
+            points.append((start + i_hi, hi))
+            points.append((start + i_lo, lo))
+    return points
+
+
+class Envelope():
+    """Per-column min/max of a history, kept up to date on append
+
+    Samples are grouped by their index since the envelope was built into
+    buckets of size samples, size being the smallest power of two that
+    gives at most columns buckets. Appending is O(1); when the buckets
+    run over, pairs are merged and size doubles. A bucket is [bucket
+    number, index of min, min, index of max, max].
+    """
+
+    def __init__(self, values, columns):
+        self.columns = columns
+        self.size = 1
+        self.total = 0
+        self.buckets = deque()
+        for count, value in enumerate(values, 1):
+            self.add(value, count)
+
+    def add(self, value, count):
+        """Add the next sample, count is the history length after it"""
+        index = self.total
+        self.total += 1
+        number = index // self.size
+        buckets = self.buckets
+        if buckets and buckets[-1][0] == number:
+            bucket = buckets[-1]
+            if value < bucket[2]:
+                bucket[1:3] = index, value
+            if value > bucket[4]:
+                bucket[3:5] = index, value
+        else:
+            buckets.append([number, index, value, index, value])
+        # Drop the buckets that left the history
+        oldest = self.total - count
+        while (buckets[0][0] + 1) * self.size <= oldest:
+            buckets.popleft()
+        if len(buckets) > self.columns:
+            self.merge()
+
+    def merge(self):
+        self.size *= 2
+        merged = deque()
+        for number, i_lo, lo, i_hi, hi in self.buckets:
+            number //= 2
+            if merged and merged[-1][0] == number:
+                bucket = merged[-1]
+                if lo < bucket[2]:
+                    bucket[1:3] = i_lo, lo
+                if hi > bucket[4]:
+                    bucket[3:5] = i_hi, hi
+            else:
+                merged.append([number, i_lo, lo, i_hi, hi])
+        self.buckets = merged
+
+    def points(self, series):
+        """(points, min, max) with positions in the series' index space"""
+        oldest = self.total - len(series)
+        first = self.buckets[0]
+        if first[1] < oldest or first[3] < oldest:
+            # The extreme left the history, rescan what is left of it
+            end = (first[0] + 1) * self.size
+            values = series.value_range(0, end - oldest)
+            lo, hi = min(values), max(values)
+            first[1:5] = (oldest + values.index(lo), lo,
+                          oldest + values.index(hi), hi)
+        points = []
+        for _, i_lo, lo, i_hi, hi in self.buckets:
+            if i_lo == i_hi:
+                points.append((i_lo - oldest, lo))
+            elif i_lo < i_hi:
+                points.append((i_lo - oldest, lo))
+                points.append((i_hi - oldest, hi))
+            else:
+                points.append((i_hi - oldest, hi))
+                points.append((i_lo - oldest, lo))
+        return (points, min(b[2] for b in self.buckets),
+                max(b[4] for b in self.buckets))
+
+
+def rollup_slot(span, now):
+    """Bucket of now in a rollup span, None for the raw history"""
+    if span not in ROLLUP_TIERS:
+        return None
+    return now // ROLLUP_TIERS[span][0]
+
+
+def split_runs(points):
+    """Runs of (position, value) points between NaN gaps"""
+    runs = [[]]
+    for point in points:
+        if point[1] != point[1]:
+            if runs[-1]:
+                runs.append([])
+        else:
+            runs[-1].append(point)
+    return [run for run in runs if run]
+
+
+def stack_values(below, values):
+    """Add the newest-aligned values of the series below"""
+    if below is None:
+        return values
+    offset = len(below) - len(values)
+    if offset >= 0:
+        return array('d', map(operator.add, values, below[offset:]))
+    return values[:-offset] + array(
+        'd', map(operator.add, values[-offset:], below))
+
+
+def layer_context(surface):
+    """Cairo context drawing on a cleared cached layer"""
+    cr = cairo.Context(surface)
+    cr.set_operator(cairo.OPERATOR_CLEAR)
+    cr.paint()
+    cr.set_operator(cairo.OPERATOR_OVER)
+    return cr
+
+
+class LayerCache():
+    """Off-screen surfaces of the static parts of the chart
+
+    The base layer (background, hover glow, graph) is kept per hover
+    state, every line has its own layer. Each layer is stored with the
+    key it was rendered from and is reused while the key matches.
+    """
+
+    def __init__(self):
+        self.size = None
+        self.clear()
+
+    def clear(self):
+        self.base = {}
+        self.lines = []
+
+    def resize(self, width, height):
+        if self.size != (width, height):
+            self.size = (width, height)
+            self.clear()
+
+    def new_surface(self, cr):
+        return cr.get_target().create_similar(
+            cairo.CONTENT_COLOR_ALPHA, *self.size)
+
+    def get_base(self, hovered, key):
+        cached = self.base.get(hovered)
+        if cached and cached[0] == key:
+            return cached[1]
+        return None
+
+    def set_base(self, hovered, key, surface):
+        self.base[hovered] = (key, surface)
+
+    def get_line(self, idx, key):
+        if idx < len(self.lines) and self.lines[idx][0] == key:
+            return self.lines[idx][1]
+        return None
+
+    def set_line(self, idx, key, surface):
+        while len(self.lines) <= idx:
+            self.lines.append((None, None))
+        self.lines[idx] = (key, surface)
+
+    def trim_lines(self, count):
+        del self.lines[count:]
 
 
 class CmdChartApplet():
     def __init__(self, applet):
 
-        self.verbose = True
+        self.started = GLib.get_monotonic_time()
+        self.first_paint = None
+        self.log = Logger()
         self.applet = applet
         self.config_path = applet.get_preferences_path()
         self.applet.settings = Gio.Settings.new_with_path(
@@ -37,10 +2975,23 @@ class CmdChartApplet():
 
         # Initialize settings and other properties
         self.load_settings()
+        self.migrate_settings()
         self.log("CmdChartApplet initialized", True)
-        self.verbose = self.settings.get_boolean("verbose")
+        self.log.verbose = self.settings.get_boolean("verbose")
 
         self.drawing_area = Gtk.DrawingArea()
+        self.layers = LayerCache()
+        self.style = Style.from_settings(self.settings)
+        self.text_cache = TextLayoutCache(self.drawing_area)
+        self.text_cache.set_font(self.style.font_family,
+                                 self.style.font_size)
+        self.parsed_data = []
+        self.main_lines = []
+        self.pending_lines = None
+        self.tick_id = None
+        self.stats = CycleStats()
+        self.stats_write_id = None
+        self.line_drawn = []
         panel_height = self.applet.get_size()
         self.drawing_area.set_size_request(
                 self.settings.get_int("chart-width"),
@@ -49,6 +3000,9 @@ class CmdChartApplet():
         self.applet.connect("change-size", self.on_size_changed)
 
         self.drawing_area.connect("draw", self.on_draw)
+        # Cached layouts belong to the widget's Pango context
+        self.drawing_area.connect("style-updated", self.on_style_updated)
+        self.drawing_area.connect("screen-changed", self.on_style_updated)
 
         # Enable events on the applet itself
         self.applet.add_events(
@@ -59,64 +3013,181 @@ class CmdChartApplet():
         # Connect hover events to applet
         self.applet.connect("enter-notify-event", self.on_applet_enter)
         self.applet.connect("leave-notify-event", self.on_applet_leave)
+        # The tooltip is built when it is shown, not on every sample
+        self.tooltip_note = None
+        self.sampling_note = None
+        self.data_time = None
+        self.tooltip_cache = (None, None)
+        self.applet.set_has_tooltip(True)
+        self.applet.connect("query-tooltip", self.on_query_tooltip)
 
         self.applet.add(self.drawing_area)
         self.setup_menu()
         self.is_hovered = False
-        self.applet.show_all()
 
-        # History for graph feature
-        self.do_draw_graph = False
-        self.history = []
-        self.historyFilePath = os.path.expanduser(
-            "~/.local/share/mate-applets/cmd-applet/history.txt")
-        self.graph_color = "g"  # default graph color
-        self.graph_min = None
-        self.graph_max = None
+        # History for graph feature, one Series per GR name
+        self.series = OrderedDict()
+        self.graph_version = 0
+        self.graph_cache = (None, None)
+        self.frame_graph_version = 0
 
-        # Ensure history directory exists
-        history_dir = GLib.path_get_dirname(self.historyFilePath)
-        if not GLib.file_test(history_dir, GLib.FileTest.EXISTS):
-            GLib.mkdir_with_parents(history_dir, 0o755)
+        # Paint the last frame of the previous session right away
+        self.frame_save_id = None
+        self.span_tick_id = None
+        self.show_cached_frame()
+        self.applet.show_all()
+        self.settings.connect("changed::history-len",
+                              self.on_history_len_changed)
 
-        # Load history from file if it exists
-        if GLib.file_test(self.historyFilePath, GLib.FileTest.EXISTS):
-            try:
-                contents = GLib.file_get_contents(self.historyFilePath)[1]
-                lines = contents.decode().split('\n')
-                for line in lines:
-                    try:
-                        val = float(line)
-                        if not math.isnan(val):
-                            self.history.append(val)
-                    except Exception:
-                        continue
-                # Keep only last history-len entries
-                max_len = self.settings.get_int("history-len")
-                if len(self.history) > max_len:
-                    self.history = self.history[-max_len:]
-            except Exception as e:
-                self.log(f"Error loading history: {e}", True)
+        self.runner = CommandRunner(self.log)
+        self.builtin = None
+        self.builtin_spec = None
+        self.last_output = None
+        self.last_graph = []
+        self.stream = StreamRunner(self.log, self.on_stream_line)
+        self.push = PushServer(self.log, self.on_stream_line)
+        self.sampler = SamplerClient(self.log, self.on_sampler_message,
+                                     self.on_sampler_closed)
+        self.sampler_retry_id = None
+        self.applet.connect("destroy", self.on_applet_removed_from_panel)
 
-        self.timer_id = None
+        self.scheduler = PollScheduler(self.update_chart)
+        self.paused = set()
+        self.breaker = CircuitBreaker()
+        self.budget = CpuBudget()
+        self.sample_queued = False
+        self.pool = WorkerPool(self.log)
+        self.sources = []
+        self.restart_id = None
         self.settings.connect("changed::verbose",
-                              lambda s, k: setattr(self,
+                              lambda s, k: setattr(self.log,
                                                    'verbose',
                                                    s.get_boolean(k)))
-        self.settings.connect("changed::update-interval",
-                              self.on_interval_changed)
-        self.timer_id = GLib.timeout_add(
-            self.settings.get_int("update-interval")*1000, self.update_chart)
-        # set timer
-        self.on_interval_changed(self.settings, "update-interval")
+        for key in ("update-interval-ms", "adaptive-polling"):
+            self.settings.connect(f"changed::{key}",
+                                  self.on_interval_changed)
+
+        # Do not poll for a panel nobody can see
+        self.drawing_area.connect(
+            "map", lambda w: self.set_paused("unmapped", False))
+        self.drawing_area.connect(
+            "unmap", lambda w: self.set_paused("unmapped", True))
+        self.session = SessionWatcher(self.on_session_state, self.log)
+        self.session.start()
+        for key in ("command", "command-mode", "use-sampler", "sources",
+                    "output-format", "executor"):
+            self.settings.connect(f"changed::{key}", self.on_command_changed)
         # Redraw whenever any visual key changes
         visual_keys = ["chart-width", "chart-area-transparency",
-                       "bar-width", "graph-transparency"]
+                       "bar-width", "graph-transparency", "graph-stack",
+                       "graph-span",
+                       "font-family",
+                       "font-size", "font-color", "enable-font-shadow",
+                       "font-shadow-color"]
         for key in visual_keys:
-            self.settings.connect(f"changed::{key}",
-                                  lambda s, k: self.drawing_area.queue_draw())
+            self.settings.connect(f"changed::{key}", self.on_visual_changed)
+
+        # History and the first command run wait until the panel is up
+        self.startup_id = GLib.idle_add(self.finish_startup,
+                                        priority=GLib.PRIORITY_LOW)
+
+    def show_cached_frame(self):
+        try:
+            with open(frame_path(self.config_path)) as f:
+                output = f.read()
+        except OSError:
+            return
+        # Builtin and plugin frames are cached in the text syntax, so
+        # the content and not output-format tells the parser
+        if output.lstrip().startswith("{"):
+            lines = parse_json_frame(output, self.log)
+        else:
+            lines = parse_frame(output, self.log)
+        # Graph values of the cached frame are in the history already
+        self.main_lines, _ = split_frame(lines)
+        self.parsed_data = self.main_lines
+
+    def save_frame(self):
+        """Persist the last output for show_cached_frame"""
+        self.frame_save_id = None
+        output = self.last_output
+        if output is None:
+            return False
+        if not isinstance(output, str):
+            output = frame_text(output)
+        try:
+            with open(frame_path(self.config_path), "w") as f:
+                f.write(output)
+        except OSError as e:
+            self.log.error("Error saving last frame: %s", e)
+        return False
+
+    def schedule_frame_save(self):
+        if not self.frame_save_id:
+            self.frame_save_id = GLib.timeout_add_seconds(
+                HISTORY_FLUSH_DELAY, self.save_frame)
+
+    def finish_startup(self):
+        """Load the history and start sampling after the first paint"""
+        self.startup_id = None
+        # Ensure history directory exists
+        history_dir = os.path.expanduser(HISTORY_DIR)
+        if not GLib.file_test(history_dir, GLib.FileTest.EXISTS):
+            GLib.mkdir_with_parents(history_dir, 0o755)
+
+        # Load history of this instance
+        for name in [''] + saved_series(self.config_path):
+            self.get_series(name)
+        self.graph_version += 1
+        self.queue_frame()
+        self.start_sampling()
+        return False
+
+    def on_visual_changed(self, settings, key):
+        self.style = Style.from_settings(settings)
+        self.text_cache.set_font(self.style.font_family,
+                                 self.style.font_size)
+        self.layers.clear()
+        self.drawing_area.queue_draw()
+
+    def on_style_updated(self, widget, *args):
+        self.text_cache.clear()
+        self.layers.clear()
+
+    def get_series(self, name):
+        """Series by name, created and loaded from disk on first use
+
+        Returns None for a new named series once SERIES_MAX are in use.
+        """
+        series = self.series.get(name)
+        if series is None:
+            if name and sum(1 for n in self.series if n) >= SERIES_MAX:
+                self.log.warning("Too many graph series, %s dropped", name)
+                return None
+            hlen = min(self.settings.get_int("history-len"), HISTORY_MAX)
+            series = self.series[name] = Series(name, hlen)
+            try:
+                series.file = HistoryFile(
+                    series_path(self.config_path, name), hlen, self.log,
+                    legacy=not name)
+                series.resize(hlen, series.file.values())
+                for tier, rollup in series.rollups.items():
+                    rollup.file = RollupFile(
+                        rollup_path(self.config_path, name, tier),
+                        rollup.buckets.maxlen, self.log)
+                    rollup.load(rollup.file.read_records())
+            except (OSError, ValueError) as e:
+                self.log.error("Error loading history: %s", e)
+        return series
 
-        self.update_chart()
+    def on_history_len_changed(self, settings, key):
+        hlen = min(settings.get_int(key), HISTORY_MAX)
+        for series in self.series.values():
+            if series.file:
+                series.file.open(hlen)
+            series.resize(hlen)
+        self.graph_version += 1
+        self.drawing_area.queue_draw()
 
     def on_size_changed(self, applet, size):
         """Update the drawing area size when the panel is resized or moved."""
@@ -126,17 +3197,171 @@ class CmdChartApplet():
         self.drawing_area.queue_draw()
 
     def on_interval_changed(self, settings, key):
-        # Remove old timer and start a new one with the updated value
-        if hasattr(self, 'timer_id') and self.timer_id:
-            GLib.source_remove(self.timer_id)
-            self.timer_id = None
+        # Restart the scheduler with the updated value
+        self.scheduler.stop()
+        if self.is_push_mode():
+            return
+
+        command = settings.get_string("command")
+        if not command.startswith((BUILTIN_PREFIX, PLUGIN_PREFIX)):
+            if self.is_stream_mode():
+                return
+            if self.sampler.sock:
+                # Subscribe again with the new interval
+                self.sampler.close()
+                self.start_sampler(SAMPLER_CONNECT_RETRIES)
+                return
+        self.scheduler.start(self.interval_seconds(),
+                             settings.get_boolean("adaptive-polling"))
+
+    def interval_seconds(self):
+        return self.settings.get_int("update-interval-ms") / 1000
+
+    def on_session_state(self, reason, active):
+        """Pause polling while the screen is locked or the session idle"""
+        self.log.debug("Session %s: %s", reason, active)
+        self.set_paused(reason, active)
+
+    def set_paused(self, reason, paused):
+        """Pause or resume all schedulers, new ones get self.paused too"""
+        if paused:
+            self.paused.add(reason)
+        else:
+            self.paused.discard(reason)
+        for scheduler in [self.scheduler] + \
+                [source.scheduler for source in self.sources]:
+            if paused:
+                scheduler.pause(reason)
+            else:
+                scheduler.resume(reason)
+
+    def is_stream_mode(self):
+        return self.settings.get_string("command-mode") == "stream"
+
+    def is_push_mode(self):
+        return self.settings.get_string("command-mode") == "push"
+
+    def start_sampling(self):
+        """Start polling or streaming according to command-mode"""
+        self.stop_sampling()
+        # Parse the next output even if it did not change
+        self.last_output = None
+        command = self.settings.get_string("command")
+        if command.startswith(PLUGIN_PREFIX):
+            runner_class = PluginRunner
+        elif self.settings.get_string("executor") == "coprocess":
+            runner_class = ShellCoprocess
+        else:
+            runner_class = CommandRunner
+        if not isinstance(self.runner, runner_class):
+            self.runner = runner_class(self.log)
+        # A new command starts with a closed circuit and no cost
+        self.breaker = CircuitBreaker()
+        self.budget = CpuBudget()
+        self.scheduler.set_penalty(1)
+        self.sample_queued = False
+        self.start_sources()
+        self.sampling_note = None
+        if self.is_push_mode():
+            path = push_path(self.config_path)
+            if self.push.start(path):
+                self.log(f"Waiting for pushed frames on {path}", True)
+                self.sampling_note = f"Push frames to {path}"
+        elif command.startswith((BUILTIN_PREFIX, PLUGIN_PREFIX)):
+            # Sampled in process, whatever the mode
+            self.sampling_note = command
+            self.on_interval_changed(self.settings, "update-interval-ms")
+        elif self.is_stream_mode():
+            self.log("Starting in stream mode", True)
+            self.stream.start(command)
+        elif self.settings.get_boolean("use-sampler"):
+            self.start_sampler(SAMPLER_CONNECT_RETRIES)
+        else:
+            self.on_interval_changed(self.settings, "update-interval-ms")
+        self.tooltip_note = self.sampling_note
+
+    def stop_sampling(self):
+        self.scheduler.stop()
+        self.stop_sources()
+        self.runner.cancel()
+        self.stream.stop()
+        self.push.stop()
+        self.sampler.close()
+        if self.sampler_retry_id:
+            GLib.source_remove(self.sampler_retry_id)
+            self.sampler_retry_id = None
+        if self.builtin:
+            self.builtin.close()
+            self.builtin = None
+
+    def start_sampler(self, retries):
+        """Subscribe to the shared sampler, starting it if needed"""
+        self.sampler_retry_id = None
+        if self.sampler.connect(self.settings.get_string("command"),
+                                self.interval_seconds(),
+                                self.settings.get_int("cmd-timeout")):
+            self.log("Subscribed to the shared sampler", True)
+            return False
+
+        if retries == SAMPLER_CONNECT_RETRIES:
+            self.spawn_sampler()
+        if retries > 0:
+            self.sampler_retry_id = GLib.timeout_add(
+                SAMPLER_RETRY_DELAY, self.start_sampler, retries - 1)
+        else:
+            self.log("Shared sampler unavailable, running locally", True)
+            self.on_interval_changed(self.settings, "update-interval-ms")
+        return False
+
+    def spawn_sampler(self):
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              SAMPLER_SCRIPT)
+        self.log(f"Starting shared sampler {script}", True)
+        try:
+            subprocess.Popen([sys.executable, script],
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             start_new_session=True)
+        except OSError as e:
+            self.log.error("Failed to start shared sampler: %s", e)
+
+    def on_sampler_message(self, message):
+        if "history" in message:
+            # Replayed frames only fill the series that have no history
+            # yet; persisted history and series of sources are kept
+            fill = {}
+            for output in message["history"]:
+                _, graph = split_frame(self.parse_output(output))
+                for element in graph:
+                    name = element.text
+                    if name not in fill:
+                        series = self.get_series(name)
+                        fill[name] = series is not None and not len(series)
+                    if fill[name]:
+                        self.add_graph_value(element, persist=False)
+        elif "output" in message:
+            self.on_command_done(message["output"], None)
+        elif "error" in message:
+            self.on_command_done("", message["error"])
 
-        new_interval = settings.get_int(key) * 1000
-        self.timer_id = GLib.timeout_add(new_interval, self.update_chart)
+    def on_sampler_closed(self):
+        self.log("Shared sampler went away, reconnecting", True)
+        self.sampler_retry_id = GLib.timeout_add(
+            RESTART_DELAY, self.start_sampler, SAMPLER_CONNECT_RETRIES)
 
-    def log(self, text, force=False):
-        if force or self.verbose:
-            print(text, flush=True)
+    def on_command_changed(self, settings, key):
+        # The command entry writes on every keystroke, so wait until
+        # typing settles before restarting the command
+        if self.restart_id:
+            GLib.source_remove(self.restart_id)
+        self.restart_id = GLib.timeout_add(RESTART_DELAY,
+                                           self.on_restart_timeout)
+
+    def on_restart_timeout(self):
+        self.restart_id = None
+        self.log("Command settings changed, restarting sampling", True)
+        self.start_sampling()
+        return False
 
     def on_applet_enter(self, widget, event):
         """Highlight applet on mouse enter"""
@@ -152,32 +3377,179 @@ class CmdChartApplet():
         self.drawing_area.queue_draw()
         return False
 
+    def on_query_tooltip(self, widget, x, y, keyboard_mode, tooltip):
+        tooltip.set_text(self.build_tooltip())
+        return True
+
+    def build_tooltip(self):
+        """Tooltip text: the output, graph series summary and last run
+
+        Built only when GTK asks for it, size-capped to TOOLTIP_MAX_CHARS.
+        """
+        parts = []
+        if self.tooltip_note:
+            parts.append(self.tooltip_note)
+        if self.breaker.open:
+            parts.append(self.breaker.describe())
+        if self.budget.cpu:
+            parts.append(self.budget.describe(self.scheduler.interval))
+        for source in self.sources:
+            if source.error:
+                parts.append(f"Source {source.spec.line}:"
+                             f"{source.spec.command}: {source.error}")
+        if self.last_output:
+            out = self.last_output
+            if not isinstance(out, str):
+                # Lines of a builtin or plugin
+                out = frame_text(out)
+            out = out.splitlines()
+            parts.append("Out:")
+            parts.extend(out[:TOOLTIP_OUTPUT_LINES])
+            if len(out) > TOOLTIP_OUTPUT_LINES:
+                hidden = len(out) - TOOLTIP_OUTPUT_LINES
+                parts.append(f"… {hidden} more lines")
+        elif not self.tooltip_note:
+            parts.append("No command output")
+        parts.extend(self.series_summary())
+
+        runs = self.stats.metrics.get("command")
+        if runs:
+            parts.append(f"Last run {runs[-1]:.1f}ms, "
+                         f"exit {self.stats.status}")
+        if self.data_time is not None:
+            age = max(0, time.time() - self.data_time)
+            parts.append(f"Updated {format_age(age)} ago")
+        if self.settings.get_boolean("show-stats"):
+            parts.append(self.stats.describe())
+
+        text = "\n".join(parts)
+        if len(text) > TOOLTIP_MAX_CHARS:
+            text = text[:TOOLTIP_MAX_CHARS - 1] + "…"
+        return text
+
+    def series_summary(self):
+        """Last values and min/avg/max of each graph series, cached
+        until the graph changes"""
+        version, lines = self.tooltip_cache
+        if version == self.graph_version:
+            return lines
+        lines = []
+        for name, series in self.series.items():
+            if not len(series):
+                continue
+            values = series.ordered()
+            recent = " ".join(f"{v:.4g}" for v in values[-TOOLTIP_SAMPLES:])
+            lines.append(f"{name or 'graph'}: {recent} "
+                         f"(min {min(values):.4g}, "
+                         f"avg {sum(values) / len(values):.4g}, "
+                         f"max {max(values):.4g})")
+        self.tooltip_cache = (self.graph_version, lines)
+        return lines
+
     def draw_overflow(self, widget, cr, x, y):
-        ff = self.settings.get_string("font-family")
-        if ff is None:
-            ff = "Sans"
-            self.settings.set_string("font-family", ff)
-        fs = self.settings.get_int("font-size")
-        if fs is None:
-            self.log("Oops! fs is None!", True)
-            fs = 12
-            self.settings.set_int("font-size", fs)
-        self.log(f"overflow: '{ff}' / '{fs}'")
-        cr.select_font_face(
-            ff,
-            cairo.FONT_SLANT_NORMAL,
-            cairo.FONT_WEIGHT_NORMAL)
-        cr.set_font_size(fs)
+        style = self.style
+        self.log.debug("overflow: '%s' / '%s'", style.font_family,
+                       style.font_size)
+        layout, _, baseline = self.text_cache.get(">>")
         cr.move_to(x + 1,
-                   y + fs / 3 + 1)
-        cr.show_text(">>")
+                   y + style.font_size / 3 + 1 - baseline)
+        PangoCairo.show_layout(cr, layout)
 
     def on_draw(self, widget, cr):
-        """Draw the chart based on parsed command output"""
+        """Composite the cached layers, rendering only the stale ones"""
+        started = time.perf_counter()
+        self.draw_layers(widget, cr)
+        self.stats.add("draw", (time.perf_counter() - started) * 1000)
+        if self.first_paint is None:
+            self.first_paint = \
+                (GLib.get_monotonic_time() - self.started) / 1000
+            self.stats.add("startup", self.first_paint)
+            self.log(f"First paint {self.first_paint:.1f}ms after start",
+                     True)
+        total = sum(len(line) for line in self.parsed_data)
+        drawn = sum(self.line_drawn[:len(self.parsed_data)])
+        self.stats.add("elements", drawn)
+        self.stats.add("overflow", total - drawn)
+        return False
+
+    def schedule_span_tick(self):
+        """Redraw when the next bucket of the rollup span starts"""
+        if self.span_tick_id:
+            return
+        step = ROLLUP_TIERS[self.settings.get_string("graph-span")][0]
+        self.span_tick_id = GLib.timeout_add_seconds(
+            math.ceil(step - time.time() % step), self.on_span_tick)
+
+    def on_span_tick(self):
+        self.span_tick_id = None
+        self.drawing_area.queue_draw()
+        return False
+
+    def draw_layers(self, widget, cr):
         allocation = widget.get_allocation()
         width = allocation.width
         height = allocation.height
+        layers = self.layers
+        layers.resize(width, height)
+
+        # Background, hover glow and graph change rarely; rollup spans
+        # also move on with the clock
+        slot = rollup_slot(self.settings.get_string("graph-span"),
+                           time.time())
+        if slot is not None:
+            self.schedule_span_tick()
+        base_key = (self.settings.get_double("chart-area-transparency"),
+                    self.settings.get_double("graph-transparency"),
+                    self.graph_version, slot)
+        base = layers.get_base(self.is_hovered, base_key)
+        if base is None:
+            base = layers.new_surface(cr)
+            self.draw_base(layer_context(base), width, height)
+            layers.set_base(self.is_hovered, base_key, base)
+        cr.set_source_surface(base, 0, 0)
+        cr.paint()
+
+        if not self.parsed_data:
+            return
+
+        # Calculate line height
+        num_lines = len(self.parsed_data)
+        line_height = height / num_lines if num_lines > 0 else height
 
+        # Each line has its own layer, redrawn when its elements change
+        self.line_drawn[num_lines:] = []
+        self.line_drawn += [0] * (num_lines - len(self.line_drawn))
+        for line_idx, line_elements in enumerate(self.parsed_data):
+            key = (num_lines, tuple(line_elements))
+            surface = layers.get_line(line_idx, key)
+            if surface is None:
+                surface = layers.new_surface(cr)
+                drawn = self.draw_line(widget, layer_context(surface),
+                                       line_elements, line_idx * line_height,
+                                       line_height, width)
+                layers.set_line(line_idx, key, surface)
+                self.line_drawn[line_idx:line_idx + 1] = [drawn]
+            cr.set_source_surface(surface, 0, 0)
+            cr.paint()
+        layers.trim_lines(num_lines)
+        if self.breaker.open:
+            self.draw_corner_mark(cr, width, (1, 0.2, 0.1))
+        elif self.budget.throttled:
+            self.draw_corner_mark(cr, width, (1, 0.7, 0))
+
+    def draw_corner_mark(self, cr, width, color):
+        """Corner mark: red while the circuit breaker is open, amber
+        while the CPU budget slows the polling"""
+        size = 6
+        cr.set_source_rgba(*color, 0.9)
+        cr.move_to(width - size, 0)
+        cr.line_to(width, 0)
+        cr.line_to(width, size)
+        cr.close_path()
+        cr.fill()
+
+    def draw_base(self, cr, width, height):
+        """Draw background, hover glow and the graph"""
         # Background with transparency
         transparency = self.settings.get_double("chart-area-transparency")
         cr.set_source_rgba(0, 0, 0, transparency)
@@ -198,226 +3570,161 @@ class CmdChartApplet():
         # Draw graph first (background)
         self.draw_graph(cr, width, height)
 
-        if not hasattr(self, 'parsed_data') or not self.parsed_data:
-            return False
+    def draw_line(self, widget, cr, line_elements, y_offset, line_height,
+                  width):
+        """Draw the separator and the elements of one line
 
-        # Calculate line height
-        num_lines = len(self.parsed_data)
-        line_height = height / num_lines if num_lines > 0 else height
+        Returns the number of elements drawn before the line overflowed.
+        """
+        style = self.style
         line_width = width  # self.applet.settings.get_int("chart-width")
+        x_offset = 3
+        cr.set_source_rgba(128, 128, 128, 0.3)
+        cr.set_line_width(1)
+        cr.move_to(x_offset, y_offset)
+        cr.line_to(width, y_offset)
+        cr.stroke()
 
-        # Draw each line
-        for line_idx, line_elements in enumerate(self.parsed_data):
-            y_offset = line_idx * line_height
-            x_offset = 3
-            cr.set_source_rgba(128, 128, 128, 0.3)
-            cr.set_line_width(1)
-            cr.move_to(x_offset, y_offset)
-            cr.line_to(width, y_offset)
-            cr.stroke()
-
-            # Draw each element in the line
-            for item in line_elements:
-                if item['type'] == 'CIRCLE':
-                    # Draw circle indicator
-                    radius = line_height / 3
-                    # Check width
-                    if x_offset + radius * 2 + 3 > line_width:
-                        self.draw_overflow(
-                            widget,
-                            cr,
-                            x_offset,
-                            y_offset + line_height / 2)
-                        break
-                    color = self.parse_color(item['color'])
-                    cr.set_source_rgb(*color)
-                    cr.arc(x_offset + radius,
-                           y_offset + line_height / 2,
-                           radius - 2,
-                           0,
-                           2 * 3.14159)
-                    cr.fill()
-                    x_offset += radius * 2 + 3
-
-                elif item['type'] == 'BAR':
-                    # Check width
-                    if (
-                        x_offset + self.applet.settings.get_int("bar-width") >
-                        width  # self.applet.settings.get_int("chart-width")
-                    ):
-                        self.draw_overflow(
-                            widget,
-                            cr,
-                            x_offset,
-                            y_offset + line_height / 2)
-                        break
-                    # Draw bar
-                    value = item['value']
-                    min_val, max_val = item['range']
-                    percentage = (value - min_val) / (max_val - min_val) \
-                        if max_val > min_val else 0
-                    bar_height = line_height * 0.8 * percentage
-
-                    color = self.parse_color(item['colors'][0])
-                    if len(item['colors']) > 1:
-                        background = self.parse_color(item['colors'][1])
-                    else:
-                        background = (1.0 - color[0],
-                                      1.0 - color[1],
-                                      1.0 - color[2],
-                                      0.2)
-                    # Draw background
-                    cr.set_source_rgba(*background)
-                    cr.rectangle(x_offset,
-                                 y_offset,
-                                 self.settings.get_int("bar-width"),
-                                 line_height)
-                    cr.fill()
-
-                    # Bar color
-                    cr.set_source_rgb(*color)
-                    cr.rectangle(x_offset,
-                                 y_offset + line_height - bar_height,
-                                 self.settings.get_int("bar-width"),
-                                 bar_height)
-                    cr.fill()
-
-                    x_offset += self.settings.get_int("bar-width") + 3
-
-                elif item['type'] == 'HBAR':
-                    # Check width
-                    if (
-                        x_offset + line_height >
-                        width  # self.applet.settings.get_int("chart-width")
-                    ):
-                        self.draw_overflow(
-                            widget,
-                            cr,
-                            x_offset,
-                            y_offset + line_height / 2)
-                        break
-                    # Draw bar
-                    value = item['value']
-                    min_val, max_val = item['range']
-                    percentage = (value - min_val) / (max_val - min_val) \
-                        if max_val > min_val else 0
-                    bar_width = line_height * 0.8 * percentage
-
-                    color = self.parse_color(item['colors'][0])
-                    if len(item['colors']) > 1:
-                        background = self.parse_color(item['colors'][1])
-                    else:
-                        background = (1.0 - color[0],
-                                      1.0 - color[1],
-                                      1.0 - color[2],
-                                      0.2)
-                    # Draw background
-                    cr.set_source_rgba(*background)
-                    cr.rectangle(x_offset,
-                                 y_offset + bar_width/2,
-                                 line_height,
-                                 self.settings.get_int("bar-width"))
-                    cr.fill()
-
-                    # Bar color
-                    cr.set_source_rgb(*color)
-                    cr.rectangle(x_offset,
-                                 y_offset + bar_width/2,
-                                 bar_width,
-                                 self.settings.get_int("bar-width"))
-                    cr.fill()
-
-                    x_offset += line_height + 3
-
-                elif item['type'] == 'TXT':
-                    # Use custom color if provided, otherwise use default
-                    text_color = item.get('color', None)
-                    if text_color:
-                        color = self.parse_color(text_color)
-                    else:
-                        color = self.parse_color(
-                            self.settings.get_string("font-color"))
-
-                    font_family = self.settings.get_string("font-family")
-                    if font_family is None:
-                        font_family = "Sans"
-                        self.settings.set_string("font-family", font_family)
-                    font_size = self.settings.get_int("font-size")
-                    if font_size is None:
-                        self.log("Oops! font_size is None...", True)
-                        font_size = 12
-                        self.settings.set_int("font-size", font_size)
-                    cr.select_font_face(
-                        font_family,
-                        cairo.FONT_SLANT_NORMAL,
-                        cairo.FONT_WEIGHT_NORMAL)
-                    cr.set_font_size(font_size)
-                    extents = cr.text_extents(item['text'])
-                    # Check width
-                    if (
-                        x_offset + extents.width >
-                        width  # self.applet.settings.get_int("chart-width")
-                    ):
-                        self.draw_overflow(
-                            widget,
-                            cr,
-                            x_offset,
-                            y_offset + line_height / 2)
-                        break
+        # Draw each element in the line
+        drawn = 0
+        for drawn, item in enumerate(line_elements):
+            if item.kind == 'CIRCLE':
+                # Draw circle indicator
+                radius = line_height / 3
+                # Check width
+                if x_offset + radius * 2 + 3 > line_width:
+                    self.draw_overflow(
+                        widget,
+                        cr,
+                        x_offset,
+                        y_offset + line_height / 2)
+                    break
+                cr.set_source_rgb(*item.color)
+                cr.arc(x_offset + radius,
+                       y_offset + line_height / 2,
+                       radius - 2,
+                       0,
+                       2 * 3.14159)
+                cr.fill()
+                x_offset += radius * 2 + 3
 
-                    # Shadow if enabled
-                    if self.settings.get_boolean("enable-font-shadow"):
-                        shadow_color = self.parse_color(
-                            self.settings.get_string("font-shadow-color"))
-                        cr.set_source_rgb(*shadow_color)
-                        cr.move_to(x_offset + 1,
-                                   y_offset + line_height / 2 +
-                                   font_size / 3 + 1)
-                        cr.show_text(item['text'])
-
-                    # Actual text
-                    cr.set_source_rgb(*color)
-                    cr.move_to(x_offset,
-                               y_offset + line_height / 2 +
-                               self.settings.get_int("font-size") / 3)
-                    cr.show_text(item['text'])
-
-                    # Update offset based on text width
-                    extents = cr.text_extents(item['text'])
-                    x_offset += extents.width + 5
+            elif item.kind == 'BAR':
+                # Check width
+                if (
+                    x_offset + style.bar_width >
+                    width  # self.applet.settings.get_int("chart-width")
+                ):
+                    self.draw_overflow(
+                        widget,
+                        cr,
+                        x_offset,
+                        y_offset + line_height / 2)
+                    break
+                # Draw bar
+                value = item.value
+                min_val, max_val = item.lo, item.hi
+                percentage = (value - min_val) / (max_val - min_val) \
+                    if max_val > min_val else 0
+                bar_height = line_height * 0.8 * percentage
 
-        return False
+                color = item.color
+                background = item.bg
+                # Draw background
+                cr.set_source_rgba(*background)
+                cr.rectangle(x_offset,
+                             y_offset,
+                             style.bar_width,
+                             line_height)
+                cr.fill()
+
+                # Bar color
+                cr.set_source_rgb(*color)
+                cr.rectangle(x_offset,
+                             y_offset + line_height - bar_height,
+                             style.bar_width,
+                             bar_height)
+                cr.fill()
+
+                x_offset += style.bar_width + 3
+
+            elif item.kind == 'HBAR':
+                # Check width
+                if (
+                    x_offset + line_height >
+                    width  # self.applet.settings.get_int("chart-width")
+                ):
+                    self.draw_overflow(
+                        widget,
+                        cr,
+                        x_offset,
+                        y_offset + line_height / 2)
+                    break
+                # Draw bar
+                value = item.value
+                min_val, max_val = item.lo, item.hi
+                percentage = (value - min_val) / (max_val - min_val) \
+                    if max_val > min_val else 0
+                bar_width = line_height * 0.8 * percentage
+
+                color = item.color
+                background = item.bg
+                # Draw background
+                cr.set_source_rgba(*background)
+                cr.rectangle(x_offset,
+                             y_offset + bar_width/2,
+                             line_height,
+                             style.bar_width)
+                cr.fill()
+
+                # Bar color
+                cr.set_source_rgb(*color)
+                cr.rectangle(x_offset,
+                             y_offset + bar_width/2,
+                             bar_width,
+                             style.bar_width)
+                cr.fill()
+
+                x_offset += line_height + 3
+
+            elif item.kind == 'TXT':
+                # Use custom color if provided, otherwise use default
+                color = item.color or style.font_color
+
+                layout, text_width, baseline = self.text_cache.get(item.text)
+                # Check width
+                if (
+                    x_offset + text_width >
+                    width  # self.applet.settings.get_int("chart-width")
+                ):
+                    self.draw_overflow(
+                        widget,
+                        cr,
+                        x_offset,
+                        y_offset + line_height / 2)
+                    break
+
+                text_y = y_offset + line_height / 2 + \
+                    style.font_size / 3 - baseline
+                # Shadow if enabled
+                if style.shadow:
+                    cr.set_source_rgb(*style.shadow_color)
+                    cr.move_to(x_offset + 1, text_y + 1)
+                    PangoCairo.show_layout(cr, layout)
+
+                # Actual text
+                cr.set_source_rgb(*color)
+                cr.move_to(x_offset, text_y)
+                PangoCairo.show_layout(cr, layout)
+
+                # Update offset based on text width
+                x_offset += text_width + 5
+        else:
+            drawn = len(line_elements)
+        return drawn
 
     def parse_color(self, color_code):
         """Parse color code like 'g' or '#FFFFFF' or '#29c' to RGB tuple"""
-        color_map = {
-            'r': (1, 0, 0),    # red
-            'g': (0, 1, 0),    # green
-            'b': (0, 0, 1),    # blue
-            'y': (1, 1, 0),    # yellow
-            'k': (0, 0, 0),    # black
-            'w': (1, 1, 1),    # white
-            'c': (0, 1, 1),    # cyan
-            'm': (1, 0, 1),    # magenta
-            'o': (1, 0.7, 0),  # orange
-        }
-
-        if color_code in color_map:
-            return color_map[color_code]
-        elif color_code.startswith('#'):
-            # Parse hex color
-            color_code = color_code.lstrip('#')
-
-            # Handle 3-character shorthand (#29c -> #2299cc)
-            if len(color_code) == 3:
-                color_code = ''.join([c*2 for c in color_code])
-
-            # Parse 6-character hex
-            if len(color_code) == 6:
-                return tuple(
-                    int(color_code[i:i+2], 16) / 255.0 for i in (0, 2, 4))
-
-        return (1, 1, 1)  # default white
+        return parse_color(color_code)
 
     def load_settings(self):
         """Load settings from config file or use defaults"""
@@ -426,7 +3733,15 @@ class CmdChartApplet():
                 "org.mate.panel.applet.CmdChartApplet",
                 self.config_path)
         except Exception as e:
-            self.log(f"Error loading settings: {e}", True)
+            self.log.error("Error loading settings: %s", e)
+
+    def migrate_settings(self):
+        """Carry an integer-second update-interval over to milliseconds"""
+        if self.settings.get_user_value("update-interval-ms") is None and \
+                self.settings.get_user_value("update-interval") is not None:
+            seconds = self.settings.get_int("update-interval")
+            self.log(f"Migrating update-interval {seconds}s", True)
+            self.settings.set_int("update-interval-ms", seconds * 1000)
 
     def setup_menu(self):
         """Setup the context menu for the applet"""
@@ -437,14 +3752,35 @@ class CmdChartApplet():
         action_group.add_actions([
             ("Preferences", Gtk.STOCK_PREFERENCES, "_Preferences",
              None, "Configure the applet", self.show_preferences),
+            ("ShowLog", None, "Show _Log",
+             None, "Show the recent log messages", self.show_log),
             ("About", Gtk.STOCK_ABOUT, "_About",
              None, "About this applet", self.show_about)
         ])
 
+        # Graph span, switches between the raw history and the rollups
+        action_group.add_action(
+            Gtk.Action(name="GraphSpan", label="Graph _Span"))
+        spans = ["raw"] + list(ROLLUP_TIERS)
+        labels = {"raw": "_Recent Samples", "day": "Last _Day",
+                  "week": "Last _Week", "month": "Last _Month"}
+        action_group.add_radio_actions(
+            [(f"Span-{span}", None, labels[span], None, None, idx)
+             for idx, span in enumerate(spans)],
+            spans.index(self.settings.get_string("graph-span")),
+            lambda action, current: self.settings.set_string(
+                "graph-span", spans[current.get_current_value()]))
+
         # Setup the menu
         self.applet.setup_menu(
             """
+            <menu name="GraphSpan" action="GraphSpan">
+            """ + "".join(f"""
+              <menuitem name="Span-{span}" action="Span-{span}" />"""
+                          for span in spans) + """
+            </menu>
             <menuitem name="Preferences" action="Preferences" />
+            <menuitem name="ShowLog" action="ShowLog" />
             <menuitem name="About" action="About" />
             """,
             action_group
@@ -476,11 +3812,65 @@ class CmdChartApplet():
         grid_gen.attach(entry_cmd,
                         1, 0, 1, 1)
 
+        # Mode
+        combo_mode = Gtk.ComboBoxText()
+        combo_mode.append("poll", "Run every interval")
+        combo_mode.append("stream", "Stream (one frame per line)")
+        combo_mode.append("push", "Push (frames written to a socket)")
+        self.settings.bind("command-mode", combo_mode, "active-id",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(Gtk.Label(label="Mode:", xalign=0),
+                        0, 4, 1, 1)
+        grid_gen.attach(combo_mode,
+                        1, 4, 1, 1)
+
+        combo_format = Gtk.ComboBoxText()
+        combo_format.append("text", "Text (CR: BAR: TXT: ...)")
+        combo_format.append("json", "JSON frames")
+        self.settings.bind("output-format", combo_format, "active-id",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(Gtk.Label(label="Output Format:", xalign=0),
+                        0, 9, 1, 1)
+        grid_gen.attach(combo_format,
+                        1, 9, 1, 1)
+
+        combo_overlap = Gtk.ComboBoxText()
+        combo_overlap.append("skip", "Skip the tick")
+        combo_overlap.append("queue-latest", "Run again when done")
+        combo_overlap.append("cancel-previous", "Kill the running one")
+        self.settings.bind("overlap-policy", combo_overlap, "active-id",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(Gtk.Label(label="Still Running:", xalign=0),
+                        0, 10, 1, 1)
+        grid_gen.attach(combo_overlap,
+                        1, 10, 1, 1)
+
+        spin_budget = Gtk.SpinButton.new_with_range(0, 100, 0.1)
+        spin_budget.set_digits(1)
+        self.settings.bind("cpu-budget", spin_budget, "value",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(Gtk.Label(label="CPU Budget (% of a core):",
+                                  xalign=0),
+                        0, 11, 1, 1)
+        grid_gen.attach(spin_budget,
+                        1, 11, 1, 1)
+
+        combo_executor = Gtk.ComboBoxText()
+        combo_executor.append("spawn", "New shell for every run")
+        combo_executor.append("coprocess", "One persistent shell")
+        self.settings.bind("executor", combo_executor, "active-id",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(Gtk.Label(label="Executor:", xalign=0),
+                        0, 12, 1, 1)
+        grid_gen.attach(combo_executor,
+                        1, 12, 1, 1)
+
         # Intervals
-        spin_update = Gtk.SpinButton.new_with_range(1, 3600, 1)
-        self.settings.bind("update-interval", spin_update, "value",
+        spin_update = Gtk.SpinButton.new_with_range(
+            SCHED_MIN_INTERVAL * 1000, 3600000, 50)
+        self.settings.bind("update-interval-ms", spin_update, "value",
                            Gio.SettingsBindFlags.DEFAULT)
-        grid_gen.attach(Gtk.Label(label="Update Interval (s):", xalign=0),
+        grid_gen.attach(Gtk.Label(label="Update Interval (ms):", xalign=0),
                         0, 1, 1, 1)
         grid_gen.attach(spin_update,
                         1, 1, 1, 1)
@@ -493,7 +3883,7 @@ class CmdChartApplet():
         grid_gen.attach(spin_timeout,
                         1, 2, 1, 1)
 
-        spin_history = Gtk.SpinButton.new_with_range(1, 256, 1)
+        spin_history = Gtk.SpinButton.new_with_range(1, HISTORY_MAX, 1)
         self.settings.bind("history-len", spin_history, "value",
                            Gio.SettingsBindFlags.DEFAULT)
         grid_gen.attach(Gtk.Label(label="History points:", xalign=0),
@@ -501,11 +3891,31 @@ class CmdChartApplet():
         grid_gen.attach(spin_history,
                         1, 3, 1, 1)
 
+        check_sampler = Gtk.CheckButton(
+            label="Share command runs with other applets")
+        self.settings.bind("use-sampler", check_sampler, "active",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(check_sampler,
+                        1, 6, 1, 1)
+
+        check_adaptive = Gtk.CheckButton(
+            label="Poll less while idle, locked or unchanged")
+        self.settings.bind("adaptive-polling", check_adaptive, "active",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(check_adaptive,
+                        1, 7, 1, 1)
+
+        check_stats = Gtk.CheckButton(label="Show timings in the tooltip")
+        self.settings.bind("show-stats", check_stats, "active",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_gen.attach(check_stats,
+                        1, 8, 1, 1)
+
         verbose = Gtk.CheckButton(label="Verbose logging")
         self.settings.bind("verbose", verbose, "active",
                            Gio.SettingsBindFlags.DEFAULT)
         grid_gen.attach(verbose,
-                        1, 3, 1, 1)
+                        1, 5, 1, 1)
 
         # --- Tab 2: Appearance ---
         grid_app = Gtk.Grid(column_spacing=12, row_spacing=12, margin=12)
@@ -551,6 +3961,12 @@ class CmdChartApplet():
         grid_app.attach(scale_graph,
                         1, 3, 1, 1)
 
+        check_stack = Gtk.CheckButton(label="Stack graph series")
+        self.settings.bind("graph-stack", check_stack, "active",
+                           Gio.SettingsBindFlags.DEFAULT)
+        grid_app.attach(check_stack,
+                        1, 4, 1, 1)
+
         # --- Tab 3: Font & Text ---
         grid_font = Gtk.Grid(column_spacing=12, row_spacing=12, margin=12)
         notebook.append_page(grid_font, Gtk.Label(label="Text"))
@@ -584,7 +4000,51 @@ class CmdChartApplet():
         grid_font.attach(check_shadow,
                          1, 1, 1, 1)
 
+        # --- Tab 4: Sources ---
+        box_src = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
+                          spacing=6, margin=12)
+        notebook.append_page(box_src, Gtk.Label(label="Sources"))
+        box_src.pack_start(Gtk.Label(
+            label="One source per line: line:interval-ms:timeout-s:command",
+            xalign=0), False, False, 0)
+        text_src = Gtk.TextView(monospace=True)
+        buffer_src = text_src.get_buffer()
+        buffer_src.set_text("\n".join(self.settings.get_strv("sources")))
+
+        def on_sources_changed(buf):
+            text = buf.get_text(buf.get_start_iter(), buf.get_end_iter(),
+                                False)
+            self.settings.set_strv(
+                "sources", [ln.strip() for ln in text.splitlines()
+                            if ln.strip()])
+
+        buffer_src.connect("changed", on_sources_changed)
+        scroll_src = Gtk.ScrolledWindow(min_content_height=120)
+        scroll_src.add(text_src)
+        box_src.pack_start(scroll_src, True, True, 0)
+
+        dialog.show_all()
+        dialog.run()
+        dialog.destroy()
+
+    def show_log(self, action):
+        """Show the in-memory log ring, newest entries at the bottom"""
+        dialog = Gtk.Dialog(title="Cmd Chart Applet Log",
+                            transient_for=None, flags=0)
+        dialog.set_default_size(640, 360)
+        dialog.add_buttons(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+
+        view = Gtk.TextView(monospace=True, editable=False,
+                            wrap_mode=Gtk.WrapMode.WORD_CHAR)
+        view.get_buffer().set_text(self.log.dump() or "(empty)")
+        scroll = Gtk.ScrolledWindow(hexpand=True, vexpand=True)
+        scroll.add(view)
+        dialog.get_content_area().pack_start(scroll, True, True, 0)
+
         dialog.show_all()
+        buf = view.get_buffer()
+        buf.place_cursor(buf.get_end_iter())
+        view.scroll_to_mark(buf.get_insert(), 0, False, 0, 1)
         dialog.run()
         dialog.destroy()
 
@@ -600,56 +4060,320 @@ class CmdChartApplet():
         about.destroy()
 
     def update_chart(self):
-        """Execute command, parse output, and trigger redraw"""
+        """Start the command; the result is applied in on_command_done"""
         self.log("Updating chart")
 
-        try:
-            # Execute the command
-            output = self.execute_command()
-
-            # Set the raw command output as a tooltip so
-            # you can see the full text on hover
-            if output:
-                # You can format it with a header if you like
-                self.applet.set_tooltip_text(f"Out:\n{output}")
+        if self.runner.busy:
+            # Do not stack processes when the command is slower than the
+            # update interval, overlap-policy says what to do instead
+            policy = self.settings.get_string("overlap-policy")
+            if policy == "cancel-previous":
+                self.log("Sample still in flight, cancelling it")
+                self.runner.cancel()
             else:
-                self.applet.set_tooltip_text("No command output")
-
-            # Parse the output and store it
-            self.parsed_data = self.parse_output(output)
-
-            # Trigger a redraw of the drawing area
-            if hasattr(self, 'drawing_area'):
-                self.drawing_area.queue_draw()
+                if policy == "queue-latest":
+                    self.sample_queued = True
+                self.log("Sample still in flight, skipping this tick")
+                return True
 
+        try:
+            self.execute_command()
         except Exception as e:
-            self.log(f"Error updating chart: {e}", True)
-            traceback.print_exc()
-            sys.stdout.flush()
+            self.log.exception("Error updating chart: %s", e)
 
         return True  # Keep the timer running
 
     def execute_command(self):
-        """Execute the configured command and return output"""
+        """Start the configured command without blocking the main loop"""
+        command = self.settings.get_string("command")
+        if command.startswith(BUILTIN_PREFIX):
+            self.sample_builtin(command)
+            return
+
         self.log("Executing command...")
+        self.runner.start(self.settings.get_string("command"),
+                          self.settings.get_int("cmd-timeout"),
+                          self.on_command_finished)
+
+    def on_command_finished(self, output, error):
+        """Record the metrics of a local run, then apply it"""
+        stats = self.stats
+        stats.cycles += 1
+        if self.runner.duration is not None:
+            stats.add("command", self.runner.duration)
+        stats.status = self.runner.status if not error else error
+        stats.add("output", len(output))
+        if self.runner.usage:
+            self.account_usage(self.runner.usage)
+        self.schedule_stats_write()
+        self.record_run(run_failure(error, self.runner.status))
+        self.on_command_done(output, error)
+        if self.sample_queued:
+            # queue-latest: a tick came while this run was in flight
+            self.sample_queued = False
+            if not self.breaker.open:
+                self.update_chart()
+
+    def record_run(self, failure):
+        """Update the circuit breaker, slow the polling while it is open"""
+        if self.breaker.record(failure):
+            if self.breaker.open:
+                self.log.warning("Command keeps failing (%s), backing off",
+                                 failure)
+            else:
+                self.log("Command recovered", True)
+            self.drawing_area.queue_draw()
+        self.update_penalty()
+
+    def account_usage(self, usage):
+        """Add the rusage of a run, stretch the interval over budget"""
+        cpu, rss = usage
+        self.stats.add("cpu", cpu * 1000)
+        self.stats.add("rss", rss)
+        self.budget.add(usage)
+        if self.budget.update(self.scheduler.interval,
+                              self.settings.get_double("cpu-budget")):
+            if self.budget.throttled:
+                self.log.warning("Over the CPU budget: %s",
+                                 self.budget.describe(self.scheduler.interval))
+            else:
+                self.log("Command back within the CPU budget", True)
+            self.drawing_area.queue_draw()
+        self.update_penalty()
+
+    def update_penalty(self):
+        self.scheduler.set_penalty(max(self.breaker.factor,
+                                       self.budget.factor))
 
+    def schedule_stats_write(self):
+        if not self.stats_write_id:
+            self.stats_write_id = GLib.timeout_add_seconds(
+                STATS_WRITE_DELAY, self.write_stats)
+
+    def write_stats(self):
+        """Publish the metrics to the stats file for external tools"""
+        self.stats_write_id = None
+        path = stats_path(self.config_path)
+        data = {"pid": os.getpid(),
+                "instance": self.config_path,
+                "command": self.settings.get_string("command"),
+                "cycles": self.stats.cycles,
+                "status": self.stats.status,
+                "metrics": self.stats.summary()}
         try:
-            result = subprocess.run(
-                self.settings.get_string("command"),
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=self.settings.get_int("cmd-timeout")
-            )
-            output = result.stdout.strip()
-            self.log(f"Command output: {output}")
-            return output
-        except subprocess.TimeoutExpired:
-            self.log("Command timeout", True)
-            return ""
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            self.log.error("Error writing stats: %s", e)
+        return False
+
+    def sample_builtin(self, command):
+        """Read the built-in providers, no process is spawned"""
+        if self.builtin is None or self.builtin_spec != command:
+            if self.builtin:
+                self.builtin.close()
+            self.builtin = BuiltinSampler(command, self.log)
+            self.builtin_spec = command
+        lines = self.builtin.sample()
+        self.scheduler.report(lines != self.last_output)
+        self.apply_output(lines)
+
+    def start_sources(self):
+        """Start polling the extra sources, each on its own interval"""
+        adaptive = self.settings.get_boolean("adaptive-polling")
+        for idx, spec in enumerate(self.settings.get_strv("sources")):
+            try:
+                source = Source(f"source-{idx}", parse_source(spec))
+            except ValueError as e:
+                self.log.warning("Bad source '%s': %s", spec, e)
+                continue
+            source.scheduler = PollScheduler(
+                lambda source=source: self.run_source(source))
+            for reason in self.paused:
+                source.scheduler.pause(reason)
+            self.sources.append(source)
+            source.scheduler.start(source.spec.interval, adaptive)
+
+    def stop_sources(self):
+        self.pool.cancel()
+        if not self.sources:
+            return
+        for source in self.sources:
+            source.close()
+        self.sources = []
+        self.queue_frame()
+
+    def run_source(self, source):
+        """Sample a source, errors are recorded on it like a failed run"""
+        try:
+            self.sample_source(source)
+        except Exception as e:
+            self.on_source_done(source, "", f"{type(e).__name__}: {e}")
+            self.log.exception("Source %s failed", source.key)
+
+    def sample_source(self, source):
+        command = source.spec.command
+        if command.startswith(BUILTIN_PREFIX):
+            if source.builtin is None:
+                source.builtin = BuiltinSampler(command, self.log)
+            lines = source.builtin.sample()
+            source.scheduler.report(lines != source.last_output)
+            source.last_output = lines
+            source.lines, source.graph = split_frame(lines)
+            self.show_source(source)
+        elif command.startswith(PLUGIN_PREFIX):
+            if source.plugin is None:
+                source.plugin = PluginRunner(self.log)
+            plugin = source.plugin
+            if plugin.busy:
+                self.log.debug("Source %s still running, skipping",
+                               source.key)
+            else:
+                plugin.start(command, source.spec.timeout,
+                             lambda output, error: self.on_source_done(
+                                 source, output, error, plugin.usage))
+        elif not self.pool.submit(
+                source.key, command, source.spec.timeout,
+                lambda output, error, usage: self.on_source_done(
+                    source, output, error, usage)):
+            self.log.debug("Source %s still running, skipping", source.key)
+
+    def on_source_done(self, source, output, error, usage=None):
+        if usage:
+            source.budget.add(usage)
+            if source.budget.update(
+                    source.scheduler.interval,
+                    self.settings.get_double("cpu-budget")):
+                self.log.warning("Source %s: %s", source.key,
+                                 source.budget.describe(
+                                     source.scheduler.interval))
+            source.scheduler.set_penalty(source.budget.factor)
+        source.error = error
+        if error:
+            self.log.warning("Source %s error: %s", source.key, error)
+            source.scheduler.report(True)
+            return
+        changed = output != source.last_output
+        source.scheduler.report(changed)
+        if changed:
+            source.lines, source.graph = split_frame(
+                self.parse_output(output) if isinstance(output, str)
+                else output)
+            source.last_output = output
+        self.show_source(source)
+
+    def show_source(self, source):
+        for element in source.graph:
+            self.add_graph_value(element)
+        self.queue_frame()
+
+    def compose_lines(self):
+        """Lines of the main command with the source lines added"""
+        lines = list(self.main_lines)
+        for source in self.sources:
+            for offset, elements in enumerate(source.lines):
+                idx = source.spec.line - 1 + offset
+                while len(lines) <= idx:
+                    lines.append([])
+                lines[idx] = lines[idx] + elements
+        return lines
+
+    def on_command_done(self, output, error):
+        """Apply the command output, keep the last good frame on error"""
+        if error:
+            self.log.warning("Command error: %s", error)
+            self.tooltip_note = f"Command error: {error}"
+            self.scheduler.report(True)
+            return
+        # Back to the note of the sampling mode (the in-process command)
+        self.tooltip_note = self.sampling_note
+
+        self.scheduler.report(output != self.last_output)
+        self.log.debug("Command output: %s", output)
+        try:
+            self.apply_output(output)
+        except Exception as e:
+            self.log.exception("Error updating chart: %s", e)
+
+    def on_stream_line(self, line):
+        """Apply a frame from the stream command or a push client"""
+        self.log.debug("Stream frame: %s", line)
+        try:
+            self.apply_output(line)
         except Exception as e:
-            self.log(f"Command error: {e}", True)
-            return ""
+            self.log.exception("Error updating chart: %s", e)
+
+    def apply_output(self, output):
+        """Parse command output, store it and trigger redraw"""
+        self.data_time = time.time()
+        if not isinstance(output, str):
+            # Lines of elements from a builtin or plugin, nothing to parse
+            self.last_output = output
+            self.schedule_frame_save()
+            self.queue_frame(self.apply_frame(output))
+            return
+        if output == self.last_output:
+            # Byte-identical frame: reuse the previous parse, only the
+            # graph gets new points
+            if self.last_graph:
+                for element in self.last_graph:
+                    self.add_graph_value(element)
+                self.queue_frame()
+            return
+
+        # Parse the output, every graph value goes to the history
+        lines, self.last_graph = split_frame(self.parse_output(output))
+        for element in self.last_graph:
+            self.add_graph_value(element)
+        self.last_output = output
+        self.schedule_frame_save()
+
+        # Show it with the next display frame
+        self.queue_frame(lines)
+
+    def queue_frame(self, lines=None):
+        """Show the newest lines on the next frame of the frame clock
+
+        Samples arriving faster than the compositor presents frames are
+        coalesced, only the newest one is laid out and drawn.
+        """
+        if lines is not None:
+            self.pending_lines = lines
+        # Every mode ends up here, publish its parse and draw metrics
+        self.schedule_stats_write()
+        if self.tick_id is None:
+            self.tick_id = self.drawing_area.add_tick_callback(
+                self.on_frame_tick)
+
+    def on_frame_tick(self, widget, frame_clock):
+        self.tick_id = None
+        old_lines = self.parsed_data
+        if self.pending_lines is not None:
+            self.main_lines = self.pending_lines
+            self.pending_lines = None
+        self.parsed_data = self.compose_lines()
+        graph_changed = self.graph_version != self.frame_graph_version
+        self.frame_graph_version = self.graph_version
+        # Trigger a redraw of what changed
+        self.queue_damage(old_lines, graph_changed)
+        return False
+
+    def queue_damage(self, old_lines, graph_changed):
+        """Queue a redraw of the lines that differ from old_lines"""
+        lines = self.parsed_data
+        if graph_changed or len(old_lines) != len(lines):
+            self.drawing_area.queue_draw()
+            return
+        allocation = self.drawing_area.get_allocation()
+        line_height = allocation.height / len(lines) if lines else 0
+        for idx, (old, new) in enumerate(zip(old_lines, lines)):
+            if old != new:
+                # One extra pixel for the separator on the line top
+                y = max(0, int(idx * line_height) - 1)
+                self.drawing_area.queue_draw_area(
+                    0, y, allocation.width, math.ceil(line_height) + 2)
 
     def parse_output(self, output):
         """Parse command output into structured data
@@ -658,185 +4382,229 @@ class CmdChartApplet():
         Single line: CR:g BAR:0-100=50:k:g TXT:Status is OK
         Two lines: TXTC:#29c test || CR:g BAR:0-100=50:k:g TXT:Status OK
 
-        Returns: List of lists, where each inner list represents a line
+        Returns: List of lists of Element, each inner list is a line
         """
         self.log("Parsing output...")
 
         if not output:
             return []
 
-        # Split by || to get individual lines
-        lines = output.split('||')
-        parsed_lines = []
+        started = time.perf_counter()
+        if self.settings.get_string("output-format") == "json":
+            parsed_lines = parse_json_frame(output, self.log)
+        else:
+            parsed_lines = parse_frame(output, self.log)
+        self.stats.add("parse", (time.perf_counter() - started) * 1000)
+        self.log.debug("Parsed data: %s", parsed_lines)
+        return parsed_lines
 
-        for line in lines:
-            line = line.strip()
-            parsed_elements = []
+    def apply_frame(self, lines, persist=True):
+        """Feed GR values to the history, return the drawable lines"""
+        drawable, graph = split_frame(lines)
+        for element in graph:
+            self.add_graph_value(element, persist)
+        return drawable
 
-            if not line:
-                # Empty line - add empty list
-                parsed_lines.append([])
-                continue
+    def add_graph_value(self, element, persist=True):
+        """Append a graph value to its series and persist it"""
+        series = self.get_series(element.text)
+        if series is None:
+            return
+        series.append(element.value)
+        if element.lo is not None:
+            series.lo, series.hi = element.lo, element.hi
+        series.color = element.color
+        series.seen = True
+        self.graph_version += 1
+        # Persist history, replayed frames have no time of their own
+        if persist:
+            now = time.time()
+            if series.file:
+                series.file.append(element.value, now)
+            series.add_rollups(element.value, now)
 
-            # parts = re.split(r'(?:[^\\])\|', line)
-            parts = re.split(r'(?:[^\\])\| *', line)
-            self.log(f"PARTS: {parts}")
-            i = 0
-            while i < len(parts):
-                part = parts[i]
+    def graph_geometry(self, width):
+        """Reduced graph points, cached until a new sample arrives
 
-                if part.startswith('CR:'):
-                    # Circle/color indicator
-                    try:
-                        color = part.split(':')[1]
-                        parsed_elements.append(
-                            {'type': 'CIRCLE', 'color': color}
-                            )
-                    except Exception:
-                        self.log(f"Failed to parse {part}", True)
-
-                elif part.startswith('BAR:') or part.startswith('HBAR:'):
-                    # Bar chart: BAR:0-100=50:k:g
-                    try:
-                        info = part.split(':')
-                        bar_info = info[1]
-                        range_part, val_part = bar_info.split('=')
-                        min_val, max_val = map(int, range_part.split('-'))
-
-                        value = float(val_part)
-                        colors = info[2:] \
-                            if len(info) > 2 else ['g']
-
-                        type_str = 'HBAR' if part[0] == 'H' else 'BAR'
-                        parsed_elements.append({
-                            'type': type_str,
-                            'range': (min_val, max_val),
-                            'value': value,
-                            'colors': colors,
-                        })
-                    except Exception:
-                        self.log(f"Failed to parse {part}", True)
-
-                elif part.startswith('TXTC:'):
-                    # Text with custom color: TXTC:#29c loading...
-                    # Format: TXTC:color rest of text
-                    try:
-                        [_, color, text] = part.split(':', 3)
+        Unstacked raw history comes from the envelopes the series keep
+        up to date, so a new sample costs O(width), not O(history).
 
-                        # text = text.replace('\\|', '|')
-                    except Exception:
-                        self.log(f"Failed to parse {part}", True)
-                        color = "#eee"
-                        text = "Parse error"
+        Returns (series_list, reduced points per series, reduced min/max
+        bands, (min, max) per series, length) or None when there is
+        nothing to draw. Bands are only drawn for rollup spans that are
+        not stacked. Stacked series share one range, otherwise every
+        series is scaled to its own.
+        """
+        stacked = self.settings.get_boolean("graph-stack")
+        span = self.settings.get_string("graph-span")
+        now = time.time()
+        gaps = span in ROLLUP_TIERS
+        key = (self.graph_version, width, stacked, span,
+               rollup_slot(span, now))
+        if self.graph_cache[0] == key:
+            return self.graph_cache[1]
 
-                    parsed_elements.append({
-                        'type': 'TXT',
-                        'text': text,
-                        'color': color
-                    })
+        series_list = [s for s in self.series.values()
+                       if s.seen and s.span_len(span, now) >= 2]
+        geometry = None
+        if series_list and not stacked and not gaps:
+            # Raw history: the envelopes are kept up to date on append
+            length = max(len(s) for s in series_list)
+            reduced = []
+            ranges = []
+            for series in series_list:
+                points, lo, hi = series.reduced(max(1, width))
+                reduced.append((length - len(series), points))
+                ranges.append((lo if series.lo is None else series.lo,
+                               hi if series.hi is None else series.hi))
+            geometry = (series_list, reduced, [None] * len(series_list),
+                        ranges, length)
+        elif series_list:
+            columns = []
+            bands = []
+            below = None
+            for series in series_list:
+                values, band_lo, band_hi = series.columns(span, now)
+                if stacked:
+                    values = below = stack_values(below, values)
+                    band_lo = band_hi = None
+                columns.append(values)
+                bands.append((band_lo, band_hi))
 
-                elif part.startswith('TXT:'):
-                    try:
-                        # Text: collect until next command or end
-                        text = part.split(':', 1)[1].replace('\\|', '|')
-                    except Exception:
-                        self.log(f"Failed to parse {part}", True)
-                        text = "Parse error"
-                    parsed_elements.append({
-                        'type': 'TXT',
-                        'text': text,
-                        'color': None  # Will use default font_color
-                    })
-
-                elif part.startswith('GR:'):
-                    # Graph value token
-                    try:
-                        rest = part[3:]
-                        values = rest.split(':')
-                        color, value_str = values[0:2]
-                        value = float(value_str)
-                        if len(values) == 4:
-                            self.graph_min = float(values[2])
-                            self.graph_max = float(values[3])
-                        # Update history
-                        self.history.append(value)
-                        hlen = self.settings.get_int("history-len")
-                        if len(self.history) > hlen:
-                            self.history.pop(0)
-                        # Persist history
-                        with open(self.historyFilePath, "a+") as f:
-                            f.write(f"{value_str}\n")
-                        self.graph_color = color
-                        self.do_draw_graph = True
-                    except Exception as e:
-                        import traceback
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        tb_info = traceback.extract_tb(exc_traceback)[-1]
-                        lineno = tb_info[1]
-                        filename = tb_info[0]
-                        self.log(
-                            (f"Failed to parse GR token: {e} at "
-                             f"{lineno}/{filename}"),
-                            True)
-
-                i += 1
-
-            if parsed_elements:
-                parsed_lines.append(parsed_elements)
-
-        self.log(f"Parsed data: {parsed_lines}")
-        return parsed_lines
+            if gaps:
+                # Extremes of the slots that hold data
+                columns_present = [array('d', (v for v in c if v == v))
+                                   for c in columns]
+                bands_present = [
+                    tuple(array('d', (v for v in b if v == v)) if b
+                          else None for b in band)
+                    for band in bands]
+            else:
+                columns_present = columns
+                bands_present = bands
+            lows = [s.lo for s in series_list]
+            highs = [s.hi for s in series_list]
+            if stacked:
+                lo = min([v for v in lows if v is not None] or [0])
+                if None not in highs:
+                    hi = sum(highs)
+                else:
+                    hi = max(max(c, default=0) for c in columns_present)
+                ranges = [(lo, hi)] * len(series_list)
+            else:
+                # Own range of the series, else its own extremes
+                ranges = [
+                    (min(b_lo or c) if lo is None else lo,
+                     max(b_hi or c) if hi is None else hi)
+                    for c, (b_lo, b_hi), lo, hi in zip(
+                        columns_present, bands_present, lows, highs)]
+            length = max(len(c) for c in columns)
+            buckets = max(1, width)
+            reduced = [(length - len(c), reduce_envelope(c, buckets, gaps))
+                       for c in columns]
+            reduced_bands = [
+                (reduce_envelope(b_lo, buckets, gaps),
+                 reduce_envelope(b_hi, buckets, gaps)) if b_lo else None
+                for b_lo, b_hi in bands]
+            geometry = (series_list, reduced, reduced_bands, ranges,
+                        length)
+
+        self.graph_cache = (key, geometry)
+        return geometry
 
     def draw_graph(self, cr, width, height):
-        """Draw the historical graph in the background."""
-        if not self.do_draw_graph or not self.history or len(self.history) < 2:
+        """Draw all graph series in the background."""
+        geometry = self.graph_geometry(width)
+        if geometry is None:
             return
+        series_list, reduced, bands, ranges, length = geometry
 
-        color = self.parse_color(self.graph_color or "g")
         alpha = self.settings.get_double("graph-transparency")
-        cr.set_line_width(2)
+        stacked = self.settings.get_boolean("graph-stack")
         boundary = 2
         draw_h = height - (boundary*2)
+        base_y = height - boundary
+        # All series end on the right edge
+        step = width / (length - 1)
+        cr.set_line_width(2)
 
-        step = width / (len(self.history) - 1)
-        if self.graph_min is not None:
-            min_val = self.graph_min
-        else:
-            min_val = min(self.history)
-        if self.graph_max is not None:
-            max_val = self.graph_max
-        else:
-            max_val = max(self.history)
-        range_val = max_val - min_val or 1
+        # Points of the series below, for stacking
+        below = None
+        for series, (offset, values), band, (min_val, max_val) in zip(
+                series_list, reduced, bands, ranges):
+            scale = draw_h / (max_val - min_val or 1)
+            # Rollup spans have gaps, every run between them is drawn
+            # on its own; the raw history is a single run
+            runs = [[((offset + pos) * step,
+                      base_y - (val - min_val) * scale)
+                     for pos, val in run]
+                    for run in split_runs(values)]
 
-        points = []
-        for i, val in enumerate(self.history):
-            x = i * step
-            # Scales 0-100% to the current height
-            y = (height - boundary) - ((val - min_val) / range_val) * draw_h
-            points.append((x, y))
-
-        # Draw the filled area
-        cr.set_source_rgba(*color, alpha/2)
-        cr.move_to(points[0][0], points[0][1])
-        for x, y in points[1:]:
-            cr.line_to(x, y)
-        cr.line_to(width, height)  # Down to bottom-right
-        cr.line_to(0, height)      # Across to bottom-left
-        cr.close_path()
-        cr.fill()
+            # Rollups: shade the min..max range of every bucket
+            if band:
+                for run_lo, run_hi in zip(*map(split_runs, band)):
+                    cr.move_to((offset + run_hi[0][0]) * step,
+                               base_y - (run_hi[0][1] - min_val) * scale)
+                    for pos, val in run_hi[1:]:
+                        cr.line_to((offset + pos) * step,
+                                   base_y - (val - min_val) * scale)
+                    for pos, val in reversed(run_lo):
+                        cr.line_to((offset + pos) * step,
+                                   base_y - (val - min_val) * scale)
+                    cr.close_path()
+                cr.set_source_rgba(*series.color, alpha/4)
+                cr.fill()
 
-        # Draw the top border line
-        cr.set_source_rgba(*color, alpha)
-        cr.set_line_width(2)
-        cr.move_to(points[0][0], points[0][1])
-        for x, y in points[1:]:
-            cr.line_to(x, y)
-        cr.stroke()
+            for points in runs:
+                # Build the line path once, reuse it for fill and stroke
+                cr.move_to(*points[0])
+                for x, y in points[1:]:
+                    cr.line_to(x, y)
+                line_path = cr.copy_path()
+
+                # Draw the filled area, down to the series below if
+                # stacked
+                first_x, last_x = points[0][0], points[-1][0]
+                under = [(x, y) for x, y in below or ()
+                         if first_x <= x <= last_x] if stacked else None
+                if under:
+                    for x, y in reversed(under):
+                        cr.line_to(x, y)
+                else:
+                    cr.line_to(last_x, height)  # Down to bottom-right
+                    cr.line_to(first_x, height)  # Across to bottom-left
+                cr.close_path()
+                cr.set_source_rgba(*series.color, alpha/2)
+                cr.fill()
 
-    def on_applet_removed_from_panel(self):
+                # Draw the top border line
+                cr.new_path()
+                cr.append_path(line_path)
+                cr.set_source_rgba(*series.color, alpha)
+                cr.stroke()
+            below = [point for points in runs for point in points]
+
+    def on_applet_removed_from_panel(self, *args):
         self.log("CmdChartApplet: Applet removed from panel")
-        # No explicit cleanup needed here
+        for source_id in (self.startup_id, self.frame_save_id,
+                          self.span_tick_id):
+            if source_id:
+                GLib.source_remove(source_id)
+        self.save_frame()
+        self.stop_sampling()
+        self.session.stop()
+        if self.stats_write_id:
+            GLib.source_remove(self.stats_write_id)
+            self.stats_write_id = None
+        try:
+            os.unlink(stats_path(self.config_path))
+        except OSError:
+            pass
+        if self.tick_id is not None:
+            self.drawing_area.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+        for series in self.series.values():
+            series.close()
 
 
 def main():
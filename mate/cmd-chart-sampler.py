@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Shared sampler for CMD Chart applets
+
+Applet instances (MATE or Cinnamon) subscribe to a command over a Unix
+socket. Every distinct command runs once per interval no matter how many
+instances show it, and each output is sent to all subscribers. The last
+frames are kept so a new subscriber starts with the same graph history.
+
+Subscribers of the same command share one job, whatever their interval
+and timeout: it runs at the shortest interval and with the longest
+timeout asked for.
+
+Protocol, one JSON object per line:
+
+    applet  -> sampler: {"command": "...", "interval": 60, "timeout": 10}
+    sampler -> applet:  {"history": ["frame", ...]}   once, on subscribe
+                        {"output": "frame"}           after every run
+                        {"error": "timeout"}          when a run failed
+
+The sampler exits when it had no subscribers for a minute.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import signal
+import sys
+
+SOCKET_NAME = "sampler.sock"
+HISTORY_LEN = 256
+IDLE_EXIT = 60
+MIN_INTERVAL = 0.05
+MAX_LINE = 1024 * 1024
+MAX_BUFFER = 4 * 1024 * 1024
+
+
+def socket_path():
+    """Same location as GLib.get_user_runtime_dir() on the applet side"""
+    runtime = os.environ.get("XDG_RUNTIME_DIR") or \
+        os.environ.get("XDG_CACHE_HOME") or \
+        os.path.expanduser("~/.cache")
+    return os.path.join(runtime, "cmd-chart-applet", SOCKET_NAME)
+
+
+def kill_group(proc):
+    """Kill the command's session, children included"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def log(text):
+    print(f"cmd-chart-sampler: {text}", file=sys.stderr, flush=True)
+
+
+async def run_command(command, timeout):
+    """Run command in its own session, return (output, error)"""
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True)
+    except Exception as e:
+        return "", str(e)
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_group(proc)
+        await proc.wait()
+        return "", "timeout"
+    except asyncio.CancelledError:
+        # The last subscriber left in the middle of the run
+        kill_group(proc)
+        raise
+    return stdout.decode(errors="replace").strip(), None
+
+
+class Job():
+    """One distinct command shared by its subscribers"""
+
+    def __init__(self, command):
+        self.command = command
+        self.subscribers = {}
+        self.history = collections.deque(maxlen=HISTORY_LEN)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    @property
+    def interval(self):
+        return max(MIN_INTERVAL,
+                   min(interval for interval, _ in self.subscribers.values()))
+
+    @property
+    def timeout(self):
+        return max(timeout for _, timeout in self.subscribers.values())
+
+    def subscribe(self, writer, interval, timeout):
+        self.subscribers[writer] = (interval, timeout)
+        send(writer, {"history": list(self.history)})
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        else:
+            # Re-evaluate the sleep, the new interval may be shorter
+            self.wakeup.set()
+
+    def unsubscribe(self, writer):
+        self.subscribers.pop(writer, None)
+        if not self.subscribers and self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.subscribers:
+            started = loop.time()
+            output, error = await run_command(self.command, self.timeout)
+            if error:
+                message = {"error": error}
+            else:
+                self.history.append(output)
+                message = {"output": output}
+            for writer in list(self.subscribers):
+                send(writer, message)
+            while self.subscribers:
+                delay = started + self.interval - loop.time()
+                if delay <= 0:
+                    break
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+
+
+def send(writer, message):
+    """Queue a message, drop subscribers that stopped reading"""
+    if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+        writer.close()
+        return
+    writer.write(json.dumps(message).encode() + b"\n")
+
+
+class Sampler():
+    def __init__(self):
+        self.jobs = {}
+        self.clients = 0
+        self.idle_handle = None
+        self.stopped = None
+
+    async def handle_client(self, reader, writer):
+        self.clients += 1
+        self.cancel_idle_exit()
+        job = None
+        try:
+            request = json.loads(await reader.readline())
+            command = str(request["command"])
+            interval = float(request.get("interval", 60))
+            timeout = float(request.get("timeout", 10))
+            job = self.jobs.get(command)
+            if job is None:
+                job = self.jobs[command] = Job(command)
+            job.subscribe(writer, interval, timeout)
+            # Subscribers do not send anything else, wait for disconnect
+            while await reader.read(4096):
+                pass
+        except (ValueError, KeyError, TypeError) as e:
+            log(f"Bad request: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            if job:
+                job.unsubscribe(writer)
+                if not job.subscribers:
+                    self.jobs.pop(job.command, None)
+            writer.close()
+            self.clients -= 1
+            if not self.clients:
+                self.schedule_idle_exit()
+
+    def schedule_idle_exit(self):
+        loop = asyncio.get_running_loop()
+        self.idle_handle = loop.call_later(IDLE_EXIT, self.stopped.set)
+
+    def cancel_idle_exit(self):
+        if self.idle_handle:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+
+    async def serve(self, path):
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_unix_server(
+            self.handle_client, path, limit=MAX_LINE)
+        os.chmod(path, 0o600)
+        log(f"Listening on {path}")
+        self.schedule_idle_exit()
+        async with server:
+            await self.stopped.wait()
+        log("No subscribers, exiting")
+
+
+def already_running(path):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def main():
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if already_running(path):
+        log("Already running")
+        return
+    if os.path.exists(path):
+        os.unlink(path)
+    try:
+        asyncio.run(Sampler().serve(path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,8 @@ setup(
     author_email='sergzhum@gmail.com',
     scripts=['cmd-chart-applet.py'],
     data_files=[
-        ('/usr/lib/mate-applets/', ['cmd-chart-applet.py']),
+        ('/usr/lib/mate-applets/', ['cmd-chart-applet.py',
+                                    'cmd-chart-sampler.py']),
         ('/usr/share/mate-panel/applets/',
          ['org.mate.panel.CmdChartApplet.mate-panel-applet']),
         ('/usr/share/applications/', ['cmd-chart-applet.desktop']),